@@ -0,0 +1,859 @@
+#!/usr/bin/python3
+
+import collections
+import contextlib
+import csv
+import getopt
+import io
+import itertools as itt
+import multiprocessing as mp
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+import vbcode
+import vbcode_fast
+
+import binary_index
+import boolean_retrieval
+import config
+import filenames
+import file_operations
+import index
+import language_operations
+import list_operations
+import search
+import vsm
+
+
+def usage():
+    print("usage: " + sys.argv[0] + " [-r repeats] benchmark ...")
+    print("benchmarks: " + ' '.join(benchmarks))
+
+
+def report(name, seconds, number):
+    print('{:<40} {:>12.3f} us/call'.format(name, seconds / number * 1e6))
+
+
+def time_best(stmt, number, repeat):
+    return min(timeit.repeat(stmt, number=number, repeat=repeat))
+
+
+def synthetic_postings(num_docs, seed=3245):
+    # A flattened posting list in the on-disk layout: doc_id, tf, [pos_idx], ...
+    rng = random.Random(seed)
+    numbers = []
+    doc_id = 0
+    for _ in range(num_docs):
+        doc_id += rng.randint(1, 200)
+        tf = min(1 + int(rng.expovariate(0.3)), 50)
+        numbers += [doc_id, tf] + sorted(rng.sample(range(1, 20000), tf))
+    return numbers
+
+
+def zipf_vocab(rng, vocab_size):
+    # Random words, and cumulative Zipf weights for drawing them with rng.choices
+    vocab = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 10))) for _ in range(vocab_size)]
+    cum_weights = list(itt.accumulate(1 / (rank + 1) for rank in range(vocab_size)))
+    return vocab, cum_weights
+
+
+def synthetic_corpus(path, num_docs, seed=3245, vocab_size=20000, mean_doc_len=500, long_doc_every=0, long_doc_len=0):
+    # Writes a CSV file in the dataset format with Zipf-distributed words.
+    # With long_doc_every, every long_doc_every-th document has long_doc_len words instead.
+    rng = random.Random(seed)
+    vocab, cum_weights = zipf_vocab(rng, vocab_size)
+
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=['document_id', 'title', 'content', 'date_posted', 'court'])
+        writer.writeheader()
+        doc_id = 0
+        for i in range(num_docs):
+            doc_id += rng.randint(1, 100)
+            doc_len = max(1, int(rng.expovariate(1 / mean_doc_len)))
+            if long_doc_every and i % long_doc_every == long_doc_every - 1: doc_len = long_doc_len
+            writer.writerow({'document_id': doc_id,
+                             'title': 'Case ' + str(i),
+                             'content': ' '.join(rng.choices(vocab, cum_weights=cum_weights, k=doc_len)),
+                             'date_posted': '2021-01-01 00:00:00',
+                             'court': 'High Court'})
+
+
+def synthetic_doc_id_map(rng, vocab, cum_weights, first_doc_id, num_docs, mean_doc_len=500):
+    # Condensed documents as produced by language_operations.process_document,
+    # without going through tokenization. Returns the doc_id_map and its last doc_id.
+    doc_id_map = {}
+    doc_id = first_doc_id
+    for _ in range(num_docs):
+        doc_id += rng.randint(1, 100)
+        doc_terms = {}
+        doc_len = max(1, int(rng.expovariate(1 / mean_doc_len)))
+        for position_idx, term in enumerate(rng.choices(vocab, cum_weights=cum_weights, k=doc_len), 1):
+            if term in doc_terms:
+                doc_terms[term][0] += 1
+                doc_terms[term][1].append(position_idx)
+            else:
+                doc_terms[term] = [1, [position_idx]]
+        doc_id_map[doc_id] = [doc_terms, vsm.compute_length_squared([vsm.compute_log_term_freq(val[0]) for val in doc_terms.values()])]
+    return doc_id_map, doc_id
+
+
+def write_synthetic_blocks(num_blocks, docs_per_block, seed=3245, vocab_size=50000):
+    # Writes num_blocks SPIMI blocks to the temp dirs. Returns block_ids and lengths_map.
+    rng = random.Random(seed)
+    vocab, cum_weights = zipf_vocab(rng, vocab_size)
+    lengths_map = {}
+    doc_id = 0
+    for block_id in range(1, num_blocks + 1):
+        doc_id_map, doc_id = synthetic_doc_id_map(rng, vocab, cum_weights, doc_id, docs_per_block)
+        file_operations.write_block(block_id, doc_id_map, lengths_map)
+    return list(range(1, num_blocks + 1)), lengths_map
+
+
+@contextlib.contextmanager
+def scratch_dir():
+    # Runs the body inside a temporary working directory with all output silenced
+    cwd = os.getcwd()
+    path = tempfile.mkdtemp()
+    os.chdir(path)
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            yield path
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(path)
+
+
+@contextlib.contextmanager
+def built_index(num_docs, **corpus_options):
+    # Indexes a synthetic corpus of num_docs documents (see synthetic_corpus) inside a scratch
+    # dir and loads it into search.index. Yields the corpus rows; the index is unloaded after.
+    with scratch_dir() as path:
+        corpus = os.path.join(path, 'corpus.csv')
+        synthetic_corpus(corpus, num_docs, **corpus_options)
+        with open(corpus, 'r', encoding='utf-8') as f:
+            rows = list(csv.DictReader(f))
+
+        try:
+            index.build_index(corpus, 'dictionary.txt', 'postings.txt')
+            file_operations.init_search('dictionary.txt', 'postings.txt', None, None)
+            search.load_index()
+            yield rows
+        finally:
+            file_operations.close_postings_reader()
+            search.index = None
+            file_operations.tombstones = None
+            file_operations.flush_temp_dirs()
+
+
+def mixed_queries(documents, rng, n):
+    # n free text queries, n conjunctions of three words and n two-word phrases OR a word,
+    # drawn from documents (lists of words). Returns (kind, queries) pairs.
+    phrase_queries = []
+    for document in rng.sample([document for document in documents if len(document) > 2], n):
+        i = rng.randrange(len(document) - 2)
+        phrase_queries.append('"' + ' '.join(document[i:i + 2]) + '" ' + document[i + 2])
+    return (
+        ('free text', [' '.join(rng.choice(rng.choice(documents)) for _ in range(6)) for _ in range(n)]),
+        ('AND', [' AND '.join(rng.choice(rng.choice(documents)) for _ in range(3)) for _ in range(n)]),
+        ('phrase OR term', phrase_queries),
+    )
+
+
+# ========================================================================
+# BENCHMARKS
+
+def bench_vbcode(repeat):
+    print('VB codec: vbcode vs vbcode_fast (numpy: ' + ('yes' if vbcode_fast.np is not None else 'no') + ')')
+    for num_docs in (10, 1000, 20000):
+        numbers = synthetic_postings(num_docs)
+        encoded = vbcode.encode(numbers)
+        assert vbcode_fast.encode(numbers) == encoded and vbcode_fast.decode(encoded) == numbers
+
+        number = max(1, 20000 // num_docs)
+        print('--- {} postings, {} numbers, {} bytes'.format(num_docs, len(numbers), len(encoded)))
+        report('vbcode.encode', time_best(lambda: vbcode.encode(numbers), number, repeat), number)
+        report('vbcode_fast.encode', time_best(lambda: vbcode_fast.encode(numbers), number, repeat), number)
+        report('vbcode_fast.encode_array', time_best(lambda: vbcode_fast.encode_array(numbers), number, repeat), number)
+        report('vbcode.decode', time_best(lambda: vbcode.decode(encoded), number, repeat), number)
+        report('vbcode_fast.decode', time_best(lambda: vbcode_fast.decode(encoded), number, repeat), number)
+        report('vbcode_fast.decode_array', time_best(lambda: vbcode_fast.decode_array(encoded), number, repeat), number)
+
+
+def bench_index_scaling(repeat, num_docs=2000):
+    # Indexing throughput with 1 to N worker processes
+    max_workers = max(config.NUM_WORKER_PROCESSES, os.cpu_count() or 1)
+    print('Indexing {} synthetic documents with 1 to {} workers'.format(num_docs, max_workers))
+
+    with scratch_dir() as path:
+        corpus = os.path.join(path, 'corpus.csv')
+        synthetic_corpus(corpus, num_docs)
+
+        timings = []
+        for num_workers in range(1, max_workers + 1):
+            best = float('inf')
+            for _ in range(repeat):
+                start = time.perf_counter()
+                index.build_index(corpus, 'dictionary.txt', 'postings.txt', num_workers=num_workers)
+                best = min(best, time.perf_counter() - start)
+            timings.append((num_workers, best))
+
+    for num_workers, best in timings:
+        print('{:>2} workers: {:>8.3f}s {:>10.1f} docs/s  speedup x{:.2f}'.format(
+            num_workers, best, num_docs / best, timings[0][1] / best))
+
+
+def bench_index_inversion(repeat, num_docs=2000):
+    # Indexing wall time with inversion in the parent vs in the workers
+    print('Indexing {} synthetic documents with {} workers'.format(num_docs, config.NUM_WORKER_PROCESSES))
+    worker_inversion = config.WORKER_INVERSION
+
+    with scratch_dir() as path:
+        corpus = os.path.join(path, 'corpus.csv')
+        synthetic_corpus(corpus, num_docs)
+
+        timings = []
+        for inversion in (False, True):
+            config.WORKER_INVERSION = inversion
+            best = float('inf')
+            for _ in range(repeat):
+                start = time.perf_counter()
+                index.build_index(corpus, 'dictionary.txt', 'postings.txt')
+                best = min(best, time.perf_counter() - start)
+            timings.append(('inversion in ' + ('workers' if inversion else 'parent'), best))
+
+    config.WORKER_INVERSION = worker_inversion
+    for name, best in timings:
+        print('{:<25} {:>8.3f}s {:>10.1f} docs/s'.format(name, best, num_docs / best))
+
+
+def bench_merge(repeat, docs_per_block=32):
+    # Merge time and peak Python memory of file_operations.merge_blocks as the
+    # number of blocks grows
+    print('Merging blocks of {} synthetic documents'.format(docs_per_block))
+    for num_blocks in (16, 64, 256):
+        with scratch_dir():
+            file_operations.init_indexing('dictionary.txt', 'postings.txt')
+            block_ids, lengths_map = write_synthetic_blocks(num_blocks, docs_per_block)
+
+            best = float('inf')
+            for _ in range(repeat):
+                start = time.perf_counter()
+                file_operations.merge_blocks(block_ids, lengths_map)
+                best = min(best, time.perf_counter() - start)
+
+            tracemalloc.start()
+            file_operations.merge_blocks(block_ids, lengths_map)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            postings_size = os.path.getsize('postings.txt')
+            file_operations.flush_temp_dirs()
+
+        print('{:>4} blocks: {:>8.3f}s  peak {:>8.1f} KiB  postings {:>8.1f} KiB'.format(
+            num_blocks, best, peak / 1024, postings_size / 1024))
+
+
+def bench_dictionary_lookup(repeat, num_terms=200000, num_lookups=2000):
+    # Startup and per-lookup cost of the in-memory, sorted on-disk text and binary dictionaries
+    print('Dictionary of {} synthetic terms, {} lookups (half misses)'.format(num_terms, num_lookups))
+    rng = random.Random(3245)
+    terms = sorted({''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 12))) for _ in range(num_terms)})
+    entries = [(term, i * 100, 100, rng.randint(1, 17000), rng.random()) for i, term in enumerate(terms)]
+    queries = rng.sample(terms, num_lookups // 2) + [term + 'q' for term in rng.sample(terms, num_lookups // 2)]
+
+    with scratch_dir():
+        with open('dictionary.txt', 'w') as mdf:
+            mdf.write(file_operations.FORMAT_HEADER + ' 2\n' + file_operations.SORTED_HEADER + ' 1\n')
+            for term, seek_ptr, bytes_to_read, df, max_wt in entries:
+                mdf.write(term + ' ' + str(seek_ptr) + ' ' + str(bytes_to_read) + ' ' + str(df) + ' ' + str(max_wt) + '\n')
+        binary_index.write_dictionary('dictionary.bin', entries, 2)
+
+        on_disk_dictionary = config.ON_DISK_DICTIONARY
+        results = []
+        for name, dict_file, on_disk in (('in-memory text', 'dictionary.txt', False),
+                                         ('sorted on-disk text', 'dictionary.txt', True),
+                                         ('binary', 'dictionary.bin', False)):
+            filenames.dict_file = dict_file
+            config.ON_DISK_DICTIONARY = on_disk
+
+            load_time = time_best(file_operations.load_dictionary, 1, repeat)
+            dictionary = file_operations.load_dictionary()
+            lookup_time = time_best(lambda: [dictionary.get(term) for term in queries], 1, repeat)
+            results.append((name, load_time, lookup_time))
+        config.ON_DISK_DICTIONARY = on_disk_dictionary
+
+    for name, load_time, lookup_time in results:
+        print('{:<22} load {:>9.3f} ms   lookup {:>8.2f} us'.format(name, load_time * 1e3, lookup_time / num_lookups * 1e6))
+
+
+def legacy_encode_term_postings(documents):
+    # The string-building serializer write_block used before encode_term_postings
+    postings = 'term'
+    prev_doc_id = 0
+    for document in documents:
+        doc_id = document[0]
+        tf = document[1][0]
+        position_indices = document[1][1]
+
+        postings = postings + ' ' + str(doc_id - prev_doc_id) + ' ' + str(tf)
+
+        prev_index = 0
+        for index in position_indices:
+            postings = postings + (' ' + str(index - prev_index))
+            prev_index = index
+        prev_doc_id = doc_id
+    return vbcode.encode([int(num) for num in postings.split()[1:]])
+
+
+def bench_write_block(repeat, docs_per_block=256):
+    # Serialization and total write time of one SPIMI block, before and after
+    # encode_term_postings replaced the string-building serializer
+    rng = random.Random(3245)
+    vocab, cum_weights = zipf_vocab(rng, 20000)
+    doc_id_map, _ = synthetic_doc_id_map(rng, vocab, cum_weights, 0, docs_per_block)
+    term_map = language_operations.get_term_postings(doc_id_map)
+    num_postings = sum(len(term_map[term][1]) for term in term_map)
+    print('Block of {} synthetic documents, {} terms, {} postings'.format(docs_per_block, len(term_map), num_postings))
+
+    def serialize_new():
+        buf = bytearray()
+        for term in term_map:
+            buf.clear()
+            file_operations.encode_term_postings(buf, term_map[term][1])
+
+    # The string-building serializer wrote postings format 2
+    postings_format = config.POSTINGS_FORMAT
+    config.POSTINGS_FORMAT = 2
+    try:
+        for term in term_map:
+            buf = bytearray()
+            file_operations.encode_term_postings(buf, term_map[term][1])
+            assert bytes(buf) == legacy_encode_term_postings(term_map[term][1])
+
+        report('serialize block (string building)', time_best(lambda: [legacy_encode_term_postings(term_map[term][1]) for term in term_map], 1, repeat), 1)
+        report('serialize block (encode_term_postings)', time_best(serialize_new, 1, repeat), 1)
+
+        with scratch_dir():
+            file_operations.init_indexing('dictionary.txt', 'postings.txt')
+            write_time = time_best(lambda: file_operations.write_block(1, doc_id_map, {}), 1, repeat)
+            file_operations.flush_temp_dirs()
+    finally:
+        config.POSTINGS_FORMAT = postings_format
+    report('write_block', write_time, 1)
+
+
+def bench_tokenize(repeat, num_docs=200):
+    # Documents per second through process_document with NLTK tokenization and
+    # uncached stemming, against the fast tokenizer with the stem cache
+    rng = random.Random(3245)
+    vocab, cum_weights = zipf_vocab(rng, 20000)
+    documents = [' '.join(rng.choices(vocab, cum_weights=cum_weights, k=max(1, int(rng.expovariate(1 / 500)))))
+                 for _ in range(num_docs)]
+
+    def run(fast_tokenizer, stem):
+        config.FAST_TOKENIZER = fast_tokenizer
+        language_operations.stem = stem
+        return [language_operations.process_document(doc_id, content) for doc_id, content in enumerate(documents)]
+
+    fast_tokenizer, cached_stem = config.FAST_TOKENIZER, language_operations.stem
+    try:
+        assert run(False, language_operations.stemmer.stem) == run(True, cached_stem)
+        for name, args in [('nltk tokenizer, uncached stem', (False, language_operations.stemmer.stem)),
+                           ('nltk tokenizer, stem cache', (False, cached_stem)),
+                           ('fast tokenizer, stem cache', (True, cached_stem))]:
+            seconds = time_best(lambda: run(*args), 1, repeat)
+            print('{:<40} {:>12.1f} docs/s'.format(name, num_docs / seconds))
+    finally:
+        config.FAST_TOKENIZER, language_operations.stem = fast_tokenizer, cached_stem
+
+
+def bench_top_k(repeat, num_docs=3000, num_queries=20, query_len=8):
+    # Scoring time of broad OR queries: ranking the whole boolean result against
+    # MaxScore top-k over the dictionary's max weights
+    print('Index of {} synthetic documents, {} OR queries of {} terms'.format(num_docs, num_queries, query_len))
+    rng = random.Random(3245)
+
+    with built_index(num_docs):
+        dictionary, N, doc_lengths = search.index
+
+        # Terms that survive index elimination, so every query matches many documents
+        terms = sorted(term for term in dictionary if 0.02 < dictionary[term][2] / N < config.ELIMINATION_THRESHOLD)
+        queries = []
+        for _ in range(num_queries):
+            vsm_query = rng.sample(terms, query_len)
+            boolean_result = boolean_retrieval.eval_rpn(boolean_retrieval.create_rpn(' OR '.join(vsm_query).split()), dictionary, N, vsm_query)
+            queries.append((set(boolean_result), vsm_query) + vsm.create_query_vector(vsm_query, dictionary, N))
+
+        def rank_all():
+            return [sorted(vsm.accumulate_scores(doc_ids, dictionary, doc_lengths, query_wt, query_length_sqr, vsm_query).items(),
+                           key=lambda x: (-x[1], x[0])) for doc_ids, vsm_query, query_wt, query_length_sqr in queries]
+
+        def rank_top_k(k):
+            return [vsm.top_k_scores(doc_ids, dictionary, doc_lengths, query_wt, query_length_sqr, vsm_query, k)
+                    for doc_ids, vsm_query, query_wt, query_length_sqr in queries]
+
+        full = rank_all()
+        timings = [('rank all', time_best(rank_all, 1, repeat))]
+        for k in (10, 100):
+            assert rank_top_k(k) == [ranking[:k] for ranking in full]
+            timings.append(('top ' + str(k), time_best(lambda: rank_top_k(k), 1, repeat)))
+
+        num_results = sum(len(doc_ids) for doc_ids, _, _, _ in queries) / num_queries
+
+    print('Average boolean result: {:.0f} documents'.format(num_results))
+    for name, seconds in timings:
+        print('{:<10} {:>10.3f} ms/query'.format(name, seconds / num_queries * 1e3))
+
+
+def bench_postings_format(repeat, num_docs=2000, num_queries=20):
+    # Postings bytes read and latency per query with positions inline (format 2),
+    # in a separate stream (format 3), and with skip blocks (format 4)
+    print('Index of {} synthetic documents, {} queries of each kind'.format(num_docs, num_queries))
+    postings_format = config.POSTINGS_FORMAT
+
+    results = []
+    try:
+        for fmt in (2, 3, 4):
+            config.POSTINGS_FORMAT = fmt
+            with built_index(num_docs) as rows:
+                # The same corpus and seed every time, so the same queries
+                rng = random.Random(3245)
+                documents = [row['content'].split() for row in rows]
+
+                # OR queries of random words, and two-word phrases taken from the documents
+                free_queries = [' '.join(rng.choice(rng.choice(documents)) for _ in range(6)) for _ in range(num_queries)]
+                phrase_queries = []
+                for document in rng.sample([document for document in documents if len(document) > 1], num_queries):
+                    i = rng.randrange(len(document) - 1)
+                    phrase_queries.append('"' + document[i] + ' ' + document[i + 1] + '"')
+
+                # Conjunctions of a rare and a frequent (but not eliminated) word
+                doc_freqs = collections.Counter(word for document in documents for word in set(document))
+                rare_words = sorted(word for word, df in doc_freqs.items() if 2 <= df <= 5)
+                common_words = sorted(word for word, df in doc_freqs.items() if 0.1 * num_docs <= df < 0.3 * num_docs)
+                and_queries = [rng.choice(rare_words) + ' AND ' + rng.choice(common_words) for _ in range(num_queries)]
+
+                reader = file_operations.get_postings_reader()
+                for kind, queries in (('free text', free_queries), ('phrase', phrase_queries), ('rare AND common', and_queries)):
+                    reader.bytes_read = 0
+                    rankings = [search.run_query(query, [], *search.index) for query in queries]
+                    bytes_read = reader.bytes_read
+                    seconds = time_best(lambda: [search.run_query(query, [], *search.index) for query in queries], 1, repeat)
+                    results.append((fmt, kind, bytes_read / num_queries, seconds / num_queries, rankings))
+    finally:
+        config.POSTINGS_FORMAT = postings_format
+
+    for fmt, kind, bytes_read, seconds, rankings in results:
+        assert rankings == [r for f, k, b, t, r in results if k == kind][0]
+        print('format {}  {:<16} {:>10.0f} bytes/query {:>9.3f} ms/query'.format(fmt, kind, bytes_read, seconds * 1e3))
+
+
+def legacy_union(a, b):
+    # list_operations.union before the linear merge; pops from the front of both inputs
+    if not a: return b
+    if not b: return a
+
+    result = []
+    while a and b:
+        if a[0] < b[0]:
+            result.append(a.pop(0))
+        elif a[0] > b[0]:
+            result.append(b.pop(0))
+        else:
+            result.append(a.pop(0))
+            b.pop(0)
+
+    if a:
+        result += a
+    if b:
+        result += b
+
+    return result
+
+
+def zipf_posting_lists(num_docs, num_terms, seed=3245):
+    # Posting lists whose lengths follow Zipf's law: the term of rank r occurs in
+    # about 0.3 * num_docs / r documents
+    rng = random.Random(seed)
+    return [sorted(rng.sample(range(num_docs), max(1, int(0.3 * num_docs / rank)))) for rank in range(1, num_terms + 1)]
+
+
+def bench_set_operations(repeat, num_docs=50000, num_terms=1000):
+    # Pairwise and n-ary set operations over Zipfian posting lists
+    lists = zipf_posting_lists(num_docs, num_terms)
+    arrays = [vbcode_fast.np.array(li, dtype=vbcode_fast.np.int64) for li in lists] if vbcode_fast.np is not None else None
+    print('{} posting lists over {} documents, longest {}'.format(num_terms, num_docs, len(lists[0])))
+
+    for a_rank, b_rank in ((1, 2), (1, 50), (10, 500)):
+        a, b = lists[a_rank - 1], lists[b_rank - 1]
+        assert list_operations.union(a, b) == legacy_union(a[:], b[:]) == sorted(set(a) | set(b))
+        assert list_operations.intersect(a, b) == sorted(set(a) & set(b))
+        assert list_operations.subtract(a, b) == sorted(set(a) - set(b))
+
+        print('--- ranks {} and {}: {} and {} postings'.format(a_rank, b_rank, len(a), len(b)))
+        report('union (pop from front)', time_best(lambda: legacy_union(a[:], b[:]), 1, repeat), 1)
+        report('union', time_best(lambda: list_operations.union(a, b), 1, repeat), 1)
+        report('intersect', time_best(lambda: list_operations.intersect(a, b), 1, repeat), 1)
+        report('subtract', time_best(lambda: list_operations.subtract(a, b), 1, repeat), 1)
+        if arrays is not None:
+            a_arr, b_arr = arrays[a_rank - 1], arrays[b_rank - 1]
+            report('union (numpy)', time_best(lambda: list_operations.union(a_arr, b_arr), 1, repeat), 1)
+            report('intersect (numpy)', time_best(lambda: list_operations.intersect(a_arr, b_arr), 1, repeat), 1)
+            report('subtract (numpy)', time_best(lambda: list_operations.subtract(a_arr, b_arr), 1, repeat), 1)
+
+    # OR of a free-text query's worth of terms, as parse_boolean_query chains them
+    rng = random.Random(3245)
+    for num_lists in (4, 16):
+        ranks = sorted(rng.sample(range(num_terms), num_lists))
+        chain = [lists[rank] for rank in ranks]
+
+        def fold(operation, chain):
+            result = chain[0]
+            for li in chain[1:]: result = operation(result, li)
+            return result
+
+        assert list_operations.union_all(chain) == fold(list_operations.union, chain) == sorted(set().union(*chain))
+        assert list_operations.intersect_all(chain) == fold(list_operations.intersect, chain)
+
+        print('--- {} lists of ranks {}'.format(num_lists, ranks))
+        report('OR chain (pop from front)', time_best(lambda: fold(legacy_union, [li[:] for li in chain]), 1, repeat), 1)
+        report('OR chain (pairwise union)', time_best(lambda: fold(list_operations.union, chain), 1, repeat), 1)
+        report('union_all', time_best(lambda: list_operations.union_all(chain), 1, repeat), 1)
+        report('AND chain (pairwise intersect)', time_best(lambda: fold(list_operations.intersect, chain), 1, repeat), 1)
+        report('intersect_all', time_best(lambda: list_operations.intersect_all(chain), 1, repeat), 1)
+
+
+def legacy_eval_rpn(rpn, dictionary, N):
+    # Boolean evaluation before the query planner: binary operations, left to right as written,
+    # with every operand decoded in full (phrases are not needed here)
+    rpn = list(rpn)
+    eval_stack = []
+    while rpn:
+        token = rpn.pop(0)
+        if token in ('AND', 'OR'):
+            right = eval_stack.pop()
+            left = eval_stack.pop()
+            if token == 'AND': eval_stack.append(list_operations.intersect(left, right))
+            else: eval_stack.append(list_operations.union(left, right))
+        else:
+            eval_stack.append(boolean_retrieval.index_elimination(token, dictionary, N))
+    return eval_stack.pop()
+
+
+def bench_query_planner(repeat, num_docs=3000, num_queries=20):
+    # Boolean evaluation time and postings bytes read, left to right against the planned tree,
+    # for conjunctions written frequent terms first and for long OR chains
+    print('Index of {} synthetic documents, {} queries of each kind'.format(num_docs, num_queries))
+    rng = random.Random(3245)
+
+    with built_index(num_docs):
+        dictionary, N, doc_lengths = search.index
+        reader = file_operations.get_postings_reader()
+
+        common_terms = sorted(term for term in dictionary if 0.1 < dictionary[term][2] / N < config.ELIMINATION_THRESHOLD)
+        rare_terms = sorted(term for term in dictionary if 2 <= dictionary[term][2] <= 5)
+        terms = sorted(term for term in dictionary if dictionary[term][2] / N < config.ELIMINATION_THRESHOLD)
+        kinds = [
+            ('3 common AND rare', [' AND '.join(rng.sample(common_terms, 3) + [rng.choice(rare_terms)]) for _ in range(num_queries)]),
+            ('OR of 8', [' OR '.join(rng.sample(terms, 8)) for _ in range(num_queries)]),
+            ('(a OR b) AND (c OR d)', ['( {} OR {} ) AND ( {} OR {} )'.format(*rng.sample(common_terms, 4)) for _ in range(num_queries)]),
+        ]
+
+        results = []
+        for kind, queries in kinds:
+            rpns = [boolean_retrieval.create_rpn(query.split()) for query in queries]
+            evaluators = (
+                ('left to right', lambda rpn: legacy_eval_rpn(rpn, dictionary, N)),
+                ('planned', lambda rpn: boolean_retrieval.eval_plan(boolean_retrieval.create_plan(rpn, dictionary, N), dictionary, N)),
+            )
+            expected = None
+            for name, evaluate in evaluators:
+                reader.bytes_read = 0
+                output = [sorted(evaluate(rpn)) for rpn in rpns]
+                bytes_read = reader.bytes_read
+                assert expected is None or output == expected
+                expected = output
+                seconds = time_best(lambda: [evaluate(rpn) for rpn in rpns], 1, repeat)
+                results.append((kind, name, bytes_read / num_queries, seconds / num_queries))
+
+    for kind, name, bytes_read, seconds in results:
+        print('{:<24} {:<14} {:>10.0f} bytes/query {:>9.3f} ms/query'.format(kind, name, bytes_read, seconds * 1e3))
+
+
+def legacy_eval_phrase(terms, dictionary):
+    # Phrase matching before the phrase engine: every term's full posting list is decoded
+    # into a {doc_id: [pos - offset]} map, then the position lists are intersected per document
+    aligned = [{doc_id: [pos - offset for pos in positions] for doc_id, positions in
+                file_operations.retrieve_posting_list(term, dictionary).items()} for offset, term in enumerate(terms)]
+    result = []
+    for doc_id in list_operations.intersect_all([list(term_map) for term_map in aligned]):
+        if list_operations.intersect_all([term_map[doc_id] for term_map in aligned]): result.append(doc_id)
+    return result
+
+
+def bench_phrase(repeat, num_docs=3000, num_queries=20):
+    # Phrase matching with full posting lists against the lockstep cursor engine,
+    # and the cost of proximity queries
+    print('Index of {} synthetic documents, {} phrases of each length'.format(num_docs, num_queries))
+    rng = random.Random(3245)
+
+    with built_index(num_docs) as rows:
+        documents = [row['content'].split() for row in rows]
+        dictionary, N, doc_lengths = search.index
+
+        timings = []
+        for length in (2, 3):
+            # Phrases taken from the documents, made only of terms that survive index elimination
+            phrases = []
+            while len(phrases) < num_queries:
+                document = rng.choice(documents)
+                i = rng.randrange(len(document) - length)
+                terms = [language_operations.stem(word.lower()) for word in document[i:i + length]]
+                if all(boolean_retrieval.is_low_idf(term, dictionary, N) for term in terms): phrases.append(terms)
+            tokens = [' AND '.join(terms).split() for terms in phrases]
+
+            assert [legacy_eval_phrase(terms, dictionary) for terms in phrases] == \
+                [boolean_retrieval.eval_phrase(token, dictionary, N) for token in tokens]
+
+            timings.append((length, 'full posting lists', time_best(lambda: [legacy_eval_phrase(terms, dictionary) for terms in phrases], 1, repeat)))
+            timings.append((length, 'lockstep cursors', time_best(lambda: [boolean_retrieval.eval_phrase(token, dictionary, N) for token in tokens], 1, repeat)))
+            for slop in (1, 5):
+                sloppy = [token + ['~' + str(slop)] for token in tokens]
+                timings.append((length, 'lockstep cursors, slop ' + str(slop),
+                                time_best(lambda: [boolean_retrieval.eval_phrase(token, dictionary, N) for token in sloppy], 1, repeat)))
+
+    for length, name, seconds in timings:
+        report('{}-term phrase, {}'.format(length, name), seconds, num_queries)
+
+
+def bench_postings_cache(repeat, num_docs=2000, num_queries=20):
+    # Postings bytes read, latency and cache hits per query with and without the per-query postings cache
+    print('Index of {} synthetic documents, {} queries of each kind'.format(num_docs, num_queries))
+    rng = random.Random(3245)
+    cache_size = config.POSTINGS_CACHE_SIZE
+
+    with built_index(num_docs) as rows:
+        kinds = mixed_queries([row['content'].split() for row in rows], rng, num_queries)
+        reader = file_operations.get_postings_reader()
+
+        results = []
+        try:
+            for kind, queries in kinds:
+                expected = None
+                for size in (0, cache_size):
+                    config.POSTINGS_CACHE_SIZE = size
+                    reader.bytes_read = 0
+                    hits = misses = 0
+                    rankings = []
+                    for query in queries:
+                        rankings.append(search.run_query(query, [], *search.index))
+                        if file_operations.postings_cache is not None:
+                            hits += file_operations.postings_cache.hits
+                            misses += file_operations.postings_cache.misses
+                    assert expected is None or rankings == expected
+                    expected = rankings
+                    bytes_read = reader.bytes_read
+                    seconds = time_best(lambda: [search.run_query(query, [], *search.index) for query in queries], 1, repeat)
+                    results.append((kind, 'cache' if size else 'no cache', bytes_read / num_queries, seconds / num_queries,
+                                    hits / num_queries, misses / num_queries))
+        finally:
+            config.POSTINGS_CACHE_SIZE = cache_size
+
+    for kind, name, bytes_read, seconds, hits, misses in results:
+        print('{:<16} {:<9} {:>8.0f} bytes/query {:>8.3f} ms/query {:>5.1f} hits {:>5.1f} misses'.format(
+            kind, name, bytes_read, seconds * 1e3, hits, misses))
+
+
+def bench_parallel_scoring(repeat, num_docs=10000, num_queries=10, query_len=8):
+    # VSM scoring of broad OR queries in the searching process against doc_id shards
+    # scored on a pool of forked workers, with the pool already running and started per query
+    print('Index of {} synthetic documents, {} OR queries of {} terms, {} CPUs'.format(num_docs, num_queries, query_len, os.cpu_count()))
+    rng = random.Random(3245)
+    scoring_processes = config.SCORING_PROCESSES
+    min_docs = config.PARALLEL_SCORING_MIN_DOCS
+
+    with built_index(num_docs, mean_doc_len=100):
+        dictionary, N, doc_lengths = search.index
+
+        terms = sorted(term for term in dictionary if 0.05 < dictionary[term][2] / N < config.ELIMINATION_THRESHOLD)
+        queries = []
+        for _ in range(num_queries):
+            vsm_query = rng.sample(terms, query_len)
+            boolean_result = boolean_retrieval.eval_rpn(boolean_retrieval.create_rpn(' OR '.join(vsm_query).split()), dictionary, N, vsm_query)
+            queries.append((set(boolean_result), vsm_query) + vsm.create_query_vector(vsm_query, dictionary, N))
+
+        def score_all():
+            return [search.score_documents(doc_ids, dictionary, doc_lengths, query_wt, query_length_sqr, vsm_query)
+                    for doc_ids, vsm_query, query_wt, query_length_sqr in queries]
+
+        def score_all_cold():
+            # Pool started and stopped around every query, as a single search.py run would
+            scores = []
+            for doc_ids, vsm_query, query_wt, query_length_sqr in queries:
+                scores.append(search.score_documents(doc_ids, dictionary, doc_lengths, query_wt, query_length_sqr, vsm_query))
+                search.close_scoring_pool()
+            return scores
+
+        timings = []
+        try:
+            config.PARALLEL_SCORING_MIN_DOCS = 1
+            config.SCORING_PROCESSES = 1
+            expected = score_all()
+            timings.append(('1 process', time_best(score_all, 1, repeat)))
+            for processes in (2, 4):
+                config.SCORING_PROCESSES = processes
+                assert score_all() == expected
+                timings.append((str(processes) + ' processes', time_best(score_all, 1, repeat)))
+                search.close_scoring_pool()
+                timings.append((str(processes) + ' processes, pool per query', time_best(score_all_cold, 1, repeat)))
+        finally:
+            config.SCORING_PROCESSES = scoring_processes
+            config.PARALLEL_SCORING_MIN_DOCS = min_docs
+            search.close_scoring_pool()
+
+    print('Average boolean result: {:.0f} documents'.format(sum(len(doc_ids) for doc_ids, _, _, _ in queries) / num_queries))
+    for name, seconds in timings:
+        print('{:<28} {:>10.3f} ms/query'.format(name, seconds / num_queries * 1e3))
+
+
+def index_in_child(corpus, settings, results):
+    # Indexes corpus with the config values in settings in a fresh process,
+    # so the peak RSS reported is this run's alone
+    for name, value in settings.items(): setattr(config, name, value)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        num_docs = index.build_index(corpus, 'dictionary.txt', 'postings.txt')
+    blocks = [line for line in output.getvalue().splitlines() if line.startswith('Blocks written')]
+    results.put((num_docs, time.perf_counter() - start) + index.peak_rss() + tuple(blocks))
+
+
+def run_index_in_child(corpus, settings):
+    results = mp.Queue()
+    child = mp.Process(target=index_in_child, args=(corpus, settings, results))
+    child.start()
+    run = results.get()
+    child.join()
+    return run
+
+
+def bench_ingestion(repeat, num_docs=1600, mean_doc_len=2500):
+    # Indexing throughput and peak RSS of the parent and the largest worker
+    # as the ingestion queue depth grows, on a corpus of long documents
+    print('Indexing {} synthetic documents of {} words on average with {} workers'.format(num_docs, mean_doc_len, config.NUM_WORKER_PROCESSES))
+
+    with scratch_dir() as path:
+        corpus = os.path.join(path, 'corpus.csv')
+        synthetic_corpus(corpus, num_docs, mean_doc_len=mean_doc_len)
+        corpus_size = os.path.getsize(corpus)
+
+        timings = []
+        for queue_depth in (1, 4, 16):
+            runs = [run_index_in_child(corpus, {'INGEST_QUEUE_DEPTH': queue_depth}) for _ in range(repeat)]
+            timings.append((queue_depth, min(runs, key=lambda run: run[1])))
+
+    print('Corpus: {:.1f} MB'.format(corpus_size / 1e6))
+    for queue_depth, (indexed, seconds, parent_rss, worker_rss, _) in timings:
+        print('queue depth {:>2}: {:>8.1f} docs/s  peak RSS {:>7.1f} MB parent {:>7.1f} MB worker'.format(
+            queue_depth, indexed / seconds, parent_rss, worker_rss))
+
+
+def bench_spimi_budget(repeat, num_docs=1000, mean_doc_len=500):
+    # Block sizes, peak RSS and throughput with blocks capped at a document count
+    # against blocks capped by a postings memory budget, on a corpus where every
+    # 50th document is 100 times longer than average
+    print('Indexing {} synthetic documents with {} workers'.format(num_docs, config.NUM_WORKER_PROCESSES))
+    settings = (
+        # The original blocks of 256 documents, split between the workers
+        ('256 documents', {'SPIMI_BLOCK_SIZE': 256 // config.NUM_WORKER_PROCESSES, 'SPIMI_MEMORY_BUDGET': 1 << 40}),
+        ('128 MB budget', {'SPIMI_BLOCK_SIZE': None, 'SPIMI_MEMORY_BUDGET': 128 << 20}),
+        ('4 MB budget', {'SPIMI_BLOCK_SIZE': None, 'SPIMI_MEMORY_BUDGET': 4 << 20}),
+    )
+
+    with scratch_dir() as path:
+        corpus = os.path.join(path, 'corpus.csv')
+        synthetic_corpus(corpus, num_docs, mean_doc_len=mean_doc_len, long_doc_every=50, long_doc_len=100 * mean_doc_len)
+
+        timings = []
+        for name, setting in settings:
+            runs = [run_index_in_child(corpus, setting) for _ in range(repeat)]
+            timings.append((name, min(runs, key=lambda run: run[1])))
+
+    for name, (indexed, seconds, parent_rss, worker_rss, blocks) in timings:
+        print('{:<14} {:>7.1f} docs/s  peak RSS {:>6.1f} MB parent {:>6.1f} MB worker'.format(name, indexed / seconds, parent_rss, worker_rss))
+        print('               ' + blocks)
+
+
+def bench_tombstones(repeat, num_docs=3000, num_queries=20):
+    # Query latency without tombstones, and with a share of the documents deleted, which has
+    # search read the index as segments and filter out the deleted postings
+    print('Index of {} synthetic documents, {} queries of each kind'.format(num_docs, num_queries))
+    rng = random.Random(3245)
+
+    with built_index(num_docs) as rows:
+        kinds = mixed_queries([row['content'].split() for row in rows], rng, num_queries)
+        doc_ids = [int(row['document_id']) for row in rows]
+
+        results = []
+        for deleted in (0, 0.001, 0.01):
+            if deleted:
+                file_operations.write_tombstones({doc_id: file_operations.DELETED
+                                                  for doc_id in rng.sample(doc_ids, int(deleted * num_docs))})
+                file_operations.close_postings_reader()
+                search.load_index()
+            for kind, queries in kinds:
+                seconds = time_best(lambda: [search.run_query(query, [], *search.index) for query in queries], 1, repeat)
+                results.append((kind, deleted, seconds / num_queries))
+
+    for kind, deleted, seconds in results:
+        print('{:<16} {:>5.1f}% deleted {:>8.3f} ms/query'.format(kind, deleted * 100, seconds * 1e3))
+
+
+benchmarks = {
+    'vbcode': bench_vbcode,
+    'index_scaling': bench_index_scaling,
+    'index_inversion': bench_index_inversion,
+    'merge': bench_merge,
+    'dictionary_lookup': bench_dictionary_lookup,
+    'write_block': bench_write_block,
+    'tokenize': bench_tokenize,
+    'top_k': bench_top_k,
+    'postings_format': bench_postings_format,
+    'set_operations': bench_set_operations,
+    'query_planner': bench_query_planner,
+    'phrase': bench_phrase,
+    'postings_cache': bench_postings_cache,
+    'parallel_scoring': bench_parallel_scoring,
+    'ingestion': bench_ingestion,
+    'spimi_budget': bench_spimi_budget,
+    'tombstones': bench_tombstones,
+}
+
+
+if __name__ == '__main__':
+    repeat = 5
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'r:')
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-r':
+            repeat = int(a)
+        else:
+            assert False, "unhandled option"
+
+    if not args or any(name not in benchmarks for name in args):
+        usage()
+        sys.exit(2)
+
+    for name in args:
+        benchmarks[name](repeat)
+        print('===================================')
@@ -0,0 +1,320 @@
+# Compact binary versions of the dictionary and lengths files.
+#
+# Both files are memory-mapped by the search side and binary-searched in place,
+# so startup time and memory no longer grow with the vocabulary or collection size.
+# Arrays are stored in native byte order and aligned to their item size, so they can be used
+# directly through memoryview.cast() without copying: from version 3 on, each array of 8-byte
+# items is preceded by zero padding up to a multiple of 8 bytes from the start of the file.
+#
+# Dictionary file:
+#     magic                 8 bytes
+#     header                version, postings_format, num_terms, block_size, num_blocks, string_table_len
+#     block offsets         uint64[num_blocks]  -> start of each front-coded block in the string table
+#     seek ptrs             uint64[num_terms]
+#     bytes to read         uint32[num_terms]
+#     dfs                   uint32[num_terms]
+#     max weights           float64[num_terms]  -> highest normalized document weight of each term
+#                                                  (version 2 and later)
+#     positions seek ptrs   uint64[num_terms]   -> only with postings format 3
+#     positions bytes       uint32[num_terms]   -> only with postings format 3
+#     skip seek ptrs        uint64[num_terms]   -> only with postings format 4
+#                                                  (padded after the uint32 positions bytes, version 3)
+#     skip bytes            uint32[num_terms]   -> only with postings format 4
+#     string table          front-coded terms, sorted by their UTF-8 bytes
+#
+# Each front-coded block holds up to block_size terms. The first term is stored in
+# full as <len><bytes>, every following term as <prefix_len><suffix_len><suffix bytes>,
+# where prefix_len is shared with the previous term. All lengths are VB-encoded.
+#
+# Lengths file:
+#     magic                 8 bytes
+#     header                N, num_docs
+#     doc_ids               uint64[num_docs], sorted
+#     lengths               float64[num_docs] (document lengths squared)
+
+import mmap
+import struct
+from array import array
+
+import vbcode_fast as vb
+
+DICT_MAGIC = b'HW4DICT\x00'
+LENGTHS_MAGIC = b'HW4LENS\x00'
+DICT_VERSION = 3
+DICT_HEADER = struct.Struct('<6Q')
+LENGTHS_HEADER = struct.Struct('<2Q')
+FRONT_CODING_BLOCK_SIZE = 16
+
+
+def is_binary_file(path, magic):
+    with open(path, 'rb') as f:
+        return f.read(len(magic)) == magic
+
+
+def read_vb(buf, ptr):
+    # Decode a single VB-encoded number starting at buf[ptr]
+    # Returns the number and the position after it
+    n = 0
+    while buf[ptr] < 128:
+        n = 128 * n + buf[ptr]
+        ptr += 1
+    return 128 * n + (buf[ptr] - 128), ptr + 1
+
+
+def common_prefix_len(a, b):
+    n = 0
+    max_len = min(len(a), len(b))
+    while n < max_len and a[n] == b[n]: n += 1
+    return n
+
+
+# ========================================================================
+# WRITERS
+
+def write_dictionary(path, entries, postings_format):
+    # entries: iterable of (term, seek_ptr, bytes_to_read, df, max_wt),
+    # followed by pos_seek_ptr, pos_bytes_to_read with postings format 3, and by
+    # skip_seek_ptr, skip_bytes_to_read with postings format 4
+    entries = sorted((entry[0].encode('utf-8'),) + tuple(entry[1:]) for entry in entries)
+
+    string_table = bytearray()
+    block_offsets = array('Q')
+    prev_term = b''
+    for i, entry in enumerate(entries):
+        term = entry[0]
+        if i % FRONT_CODING_BLOCK_SIZE == 0:
+            block_offsets.append(len(string_table))
+            vb.encode_into(string_table, len(term))
+            string_table += term
+        else:
+            prefix_len = common_prefix_len(prev_term, term)
+            vb.encode_into(string_table, prefix_len)
+            vb.encode_into(string_table, len(term) - prefix_len)
+            string_table += term[prefix_len:]
+        prev_term = term
+
+    with open(path, 'wb') as f:
+        f.write(DICT_MAGIC)
+        f.write(DICT_HEADER.pack(DICT_VERSION, postings_format, len(entries), FRONT_CODING_BLOCK_SIZE,
+                                 len(block_offsets), len(string_table)))
+        block_offsets.tofile(f)
+        array('Q', (entry[1] for entry in entries)).tofile(f)
+        array('I', (entry[2] for entry in entries)).tofile(f)
+        array('I', (entry[3] for entry in entries)).tofile(f)
+        pad_to_alignment(f)
+        array('d', (entry[4] for entry in entries)).tofile(f)
+        if postings_format >= 3:
+            pad_to_alignment(f)
+            array('Q', (entry[5] for entry in entries)).tofile(f)
+            array('I', (entry[6] for entry in entries)).tofile(f)
+        if postings_format >= 4:
+            pad_to_alignment(f)
+            array('Q', (entry[7] for entry in entries)).tofile(f)
+            array('I', (entry[8] for entry in entries)).tofile(f)
+        f.write(string_table)
+
+
+def pad_to_alignment(f, item_size=8):
+    # Zero bytes up to the next multiple of item_size in the file being written
+    f.write(bytes(-f.tell() % item_size))
+
+
+def aligned(ptr, item_size=8):
+    return ptr + (-ptr % item_size)
+
+
+def write_lengths(path, N, lengths_map):
+    doc_ids = sorted(lengths_map)
+    with open(path, 'wb') as f:
+        f.write(LENGTHS_MAGIC)
+        f.write(LENGTHS_HEADER.pack(N, len(doc_ids)))
+        array('Q', doc_ids).tofile(f)
+        array('d', (lengths_map[doc_id] for doc_id in doc_ids)).tofile(f)
+
+
+# ========================================================================
+# READERS
+
+class BinaryDictionary:
+    # Read-only mapping of term -> [seek_ptr, bytes_to_read, df, (max_wt, ...)], looked up by
+    # binary search over the first term of every front-coded block.
+    def __init__(self, path):
+        self.f = open(path, 'rb')
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.mm)
+
+        ptr = len(DICT_MAGIC)
+        (version, self.postings_format, self.num_terms, self.block_size,
+         num_blocks, string_table_len) = DICT_HEADER.unpack_from(view, ptr)
+        if version not in (1, 2, DICT_VERSION):
+            raise ValueError('Unsupported binary dictionary version ' + str(version))
+        ptr += DICT_HEADER.size
+
+        self.block_offsets = view[ptr:ptr + 8 * num_blocks].cast('Q')
+        ptr += 8 * num_blocks
+        self.seek_ptrs = view[ptr:ptr + 8 * self.num_terms].cast('Q')
+        ptr += 8 * self.num_terms
+        self.bytes_to_read = view[ptr:ptr + 4 * self.num_terms].cast('I')
+        ptr += 4 * self.num_terms
+        self.dfs = view[ptr:ptr + 4 * self.num_terms].cast('I')
+        ptr += 4 * self.num_terms
+        if version >= 3: ptr = aligned(ptr) # Versions 1 and 2 are read unaligned
+        if version >= 2:
+            self.max_wts = view[ptr:ptr + 8 * self.num_terms].cast('d')
+            ptr += 8 * self.num_terms
+        else:
+            self.max_wts = None
+        if self.postings_format >= 3:
+            if version >= 3: ptr = aligned(ptr)
+            self.pos_seek_ptrs = view[ptr:ptr + 8 * self.num_terms].cast('Q')
+            ptr += 8 * self.num_terms
+            self.pos_bytes_to_read = view[ptr:ptr + 4 * self.num_terms].cast('I')
+            ptr += 4 * self.num_terms
+        else:
+            self.pos_seek_ptrs = self.pos_bytes_to_read = None
+        if self.postings_format >= 4:
+            if version >= 3: ptr = aligned(ptr)
+            self.skip_seek_ptrs = view[ptr:ptr + 8 * self.num_terms].cast('Q')
+            ptr += 8 * self.num_terms
+            self.skip_bytes_to_read = view[ptr:ptr + 4 * self.num_terms].cast('I')
+            ptr += 4 * self.num_terms
+        else:
+            self.skip_seek_ptrs = self.skip_bytes_to_read = None
+        self.string_table = view[ptr:ptr + string_table_len]
+
+    def block_first_term(self, block):
+        length, ptr = read_vb(self.string_table, self.block_offsets[block])
+        return bytes(self.string_table[ptr:ptr + length])
+
+    def iter_block(self, block):
+        # Yields (term_idx, term) for every term in the block, as UTF-8 bytes
+        ptr = self.block_offsets[block]
+        term_idx = block * self.block_size
+        last_idx = min(term_idx + self.block_size, self.num_terms)
+
+        length, ptr = read_vb(self.string_table, ptr)
+        term = bytes(self.string_table[ptr:ptr + length])
+        ptr += length
+        yield term_idx, term
+
+        for term_idx in range(term_idx + 1, last_idx):
+            prefix_len, ptr = read_vb(self.string_table, ptr)
+            suffix_len, ptr = read_vb(self.string_table, ptr)
+            term = term[:prefix_len] + bytes(self.string_table[ptr:ptr + suffix_len])
+            ptr += suffix_len
+            yield term_idx, term
+
+    def find(self, term):
+        # Returns the index of term in the sorted term arrays, or -1
+        key = term.encode('utf-8')
+
+        # Find the last block whose first term is <= key
+        low = 0
+        high = len(self.block_offsets) - 1
+        block = -1
+        while low <= high:
+            mid = (low + high) // 2
+            if self.block_first_term(mid) <= key:
+                block = mid
+                low = mid + 1
+            else:
+                high = mid - 1
+
+        if block < 0: return -1
+
+        for term_idx, block_term in self.iter_block(block):
+            if block_term == key: return term_idx
+            if block_term > key: break
+        return -1
+
+    def entry(self, term_idx):
+        if self.max_wts is None:
+            return [self.seek_ptrs[term_idx], self.bytes_to_read[term_idx], self.dfs[term_idx]]
+        entry = [self.seek_ptrs[term_idx], self.bytes_to_read[term_idx], self.dfs[term_idx], self.max_wts[term_idx]]
+        if self.pos_seek_ptrs is not None:
+            entry += [self.pos_seek_ptrs[term_idx], self.pos_bytes_to_read[term_idx]]
+        if self.skip_seek_ptrs is not None:
+            entry += [self.skip_seek_ptrs[term_idx], self.skip_bytes_to_read[term_idx]]
+        return entry
+
+    def __contains__(self, term):
+        return isinstance(term, str) and self.find(term) >= 0
+
+    def __getitem__(self, term):
+        term_idx = self.find(term) if isinstance(term, str) else -1
+        if term_idx < 0: raise KeyError(term)
+        return self.entry(term_idx)
+
+    def get(self, term, default=None):
+        term_idx = self.find(term) if isinstance(term, str) else -1
+        return self.entry(term_idx) if term_idx >= 0 else default
+
+    def __len__(self):
+        return self.num_terms
+
+    def __iter__(self):
+        for block in range(len(self.block_offsets)):
+            for _, term in self.iter_block(block):
+                yield term.decode('utf-8')
+
+    def close(self):
+        for view in (self.block_offsets, self.seek_ptrs, self.bytes_to_read, self.dfs, self.max_wts,
+                     self.pos_seek_ptrs, self.pos_bytes_to_read, self.skip_seek_ptrs, self.skip_bytes_to_read,
+                     self.string_table):
+            if view is not None: view.release()
+        self.mm.close()
+        self.f.close()
+
+
+class BinaryLengths:
+    # Read-only mapping of doc_id -> document length squared, looked up by
+    # binary search over the sorted doc_id array.
+    def __init__(self, path):
+        self.f = open(path, 'rb')
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.mm)
+
+        ptr = len(LENGTHS_MAGIC)
+        self.N, num_docs = LENGTHS_HEADER.unpack_from(view, ptr)
+        ptr += LENGTHS_HEADER.size
+
+        self.doc_ids = view[ptr:ptr + 8 * num_docs].cast('Q')
+        ptr += 8 * num_docs
+        self.lengths = view[ptr:ptr + 8 * num_docs].cast('d')
+
+    def find(self, doc_id):
+        low = 0
+        high = len(self.doc_ids) - 1
+        while low <= high:
+            mid = (low + high) // 2
+            if self.doc_ids[mid] < doc_id:
+                low = mid + 1
+            elif self.doc_ids[mid] > doc_id:
+                high = mid - 1
+            else:
+                return mid
+        return -1
+
+    def __contains__(self, doc_id):
+        return self.find(doc_id) >= 0
+
+    def __getitem__(self, doc_id):
+        idx = self.find(doc_id)
+        if idx < 0: raise KeyError(doc_id)
+        return self.lengths[idx]
+
+    def get(self, doc_id, default=None):
+        idx = self.find(doc_id)
+        return self.lengths[idx] if idx >= 0 else default
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __iter__(self):
+        return iter(self.doc_ids)
+
+    def close(self):
+        self.doc_ids.release()
+        self.lengths.release()
+        self.mm.close()
+        self.f.close()
@@ -1,3 +1,6 @@
+import time
+
+import config
 import file_operations
 import list_operations
 import vsm
@@ -33,20 +36,34 @@ def is_term(string):
 # ========================================================================
 # INDEX ELIMINATION METHODS
 
-def remove_low_idf(token, dictionary, N):
-    pl = {}
+def is_low_idf(token, dictionary, N):
+    # The decision is kept for the rest of the query: the planner and the phrase
+    # engine ask for it repeatedly, and each ask is a dictionary lookup
+    cache = file_operations.postings_cache
+    if cache is not None and token in cache.low_idf: return cache.low_idf[token]
+
+    low_idf = False
     if token in dictionary:
 
         term_df = dictionary[token][2]
-        if (term_df / N < 0.4): # low idf <-> high df/N
-            pl = file_operations.retrieve_posting_list(token, dictionary)
+        if (term_df / N < config.ELIMINATION_THRESHOLD): # low idf <-> high df/N
+            low_idf = True
+
+    if cache is not None: cache.low_idf[token] = low_idf
+    return low_idf
+
+
+def remove_low_idf(token, dictionary, N):
+    pl = []
+    if is_low_idf(token, dictionary, N):
+        pl = file_operations.retrieve_doc_ids(token, dictionary)
 
     return pl
 
 
 def index_elimination(token, dictionary, N):
-    pl = remove_low_idf(token, dictionary, N)
-    return list(pl.keys())
+    # Only the doc_ids are needed here, so positions are not decoded
+    return remove_low_idf(token, dictionary, N)
 
 
 # ========================================================================
@@ -93,106 +110,237 @@ def create_rpn(tokens):
     return rpn
 
 
-def eval_rpn(rpn, dictionary, N, vsm_query):
-    eval_stack = []
-    while rpn:
-        token = rpn.pop(0)
-
-        if isinstance(token, list):
-            if isinstance(token[0], int): eval_stack.append(token)
-            else:
-                # The current token is a phrase.
-                # Create a new RPN and evaluate the phrase,
-                # then check the positional indices.
-
-                phrase_postings = {}
-                # K: term
-                # V: { K: doc_id
-                #      V: [positions] }
-                offset = 0 # To offset positions
-
-                # For each term, align positional indices to the first term such that the intersection
-                # of all indices later on tells us if the phrase appears at least once in the document.
-                for term in token:
-                    if is_term(term):
-                        term_posting = file_operations.retrieve_posting_list(term, dictionary)
-                        
-                        # Align the positonal indices
-                        phrase_postings[term] = {doc_id: [pos - offset for pos in indices] for doc_id, indices in term_posting.items()}
-                        offset += 1
-                phrase_rpn = create_rpn(token)
-
-                for term in phrase_rpn:
-                    # We've already gotten the posting list of each term earlier above,
-                    # So substitute term with posting list of the term
-                    if is_term(term): term = list(phrase_postings[term].keys()) 
-                
-                # Returns a list of documents containing all terms in the phrase,
-                # without considering position first.
-                # phrase_result = eval_rpn(phrase_rpn, dictionary, postings_file, N)
-                phrase_result = eval_rpn(phrase_rpn, dictionary, N, vsm_query)
-
-                result = []
-
-                # Now intersect the positional indices retrieved earlier on in relation to each document
-                # in the returned list.
-                # If the list produced from the intersection has at least one element, then the
-                # document contains the phrase.
-                for doc_id in phrase_result:
-                    position_intersect = None
-
-                    for term in phrase_postings:
-                        if term not in phrase_postings or doc_id not in phrase_postings[term]: continue
-
-                        if position_intersect == None:
-                            position_intersect = phrase_postings[term][doc_id]
-                        else:
-                            position_intersect = list_operations.intersect(position_intersect, phrase_postings[term][doc_id])
-                    if position_intersect: result.append(doc_id)
-                
-                    
-                eval_stack.append(result)
-
-        elif token == 'AND':
-            right_term = eval_stack.pop()
-            left_term = eval_stack.pop()
-
-            left = []
-            right = []
-            if isinstance(left_term, str):
-                left = index_elimination(left_term, dictionary, N)
-            else:
-                left = left_term
-            
-            if isinstance(right_term, str):
-                right = index_elimination(right_term, dictionary, N)
+def phrase_terms(phrase):
+    # Splits a parsed phrase token such as ['a', 'AND', 'b', '~2'] into its terms and its slop
+    slop = 0
+    if phrase and phrase[-1][:1] == '~':
+        slop = int(phrase[-1][1:])
+        phrase = phrase[:-1]
+    return [term for term in phrase if is_term(term)], slop
+
+
+def match_positions(positions, slop):
+    # Whether the terms occur in order, with at most slop other words between the first
+    # and the last: p_0 < p_1 < ... < p_n-1 and p_n-1 - p_0 <= n - 1 + slop.
+    # positions: the sorted positions of every term in the document, in phrase order.
+    # For each position of the first term, every following term takes its first position
+    # after the previous term's, which gives the shortest span starting there. Those
+    # positions only move forward as the start does, so this is a single linear merge
+    # and nothing is allocated.
+    max_span = len(positions) - 1 + slop
+    ptrs = [0] * len(positions)
+    for start in positions[0]:
+        prev = start
+        for i in range(1, len(positions)):
+            term_positions = positions[i]
+            ptr = ptrs[i]
+            while ptr < len(term_positions) and term_positions[ptr] <= prev: ptr += 1
+            if ptr == len(term_positions): return False # No later occurrence for any later start either
+            ptrs[i] = ptr
+            prev = term_positions[ptr]
+            if prev - start > max_span: break
+        else:
+            return True
+    return False
+
+
+def eval_phrase(phrase, dictionary, N, candidates=None):
+    # Documents containing the terms of phrase in order, next to each other or,
+    # with a slop of k ("a b"~k), with at most k other words in between.
+    # candidates: if given, only these (sorted) doc_ids are checked
+    terms, slop = phrase_terms(phrase)
+    if not terms or not all(is_low_idf(term, dictionary, N) for term in terms): return []
+
+    # One cursor per distinct term, walked in lockstep from the rarest term
+    cursors = {term: file_operations.PostingsCursor(term, dictionary) for term in terms}
+    by_df = sorted(cursors, key=lambda term: dictionary[term][2])
+    rarest = cursors[by_df[0]]
+    others = [cursors[term] for term in by_df[1:]]
+
+    result = []
+    doc_ids = iter(candidates) if candidates is not None else None
+    doc_id = next(doc_ids, None) if doc_ids is not None else rarest.doc_id
+    while doc_id is not None:
+        # Move every cursor to doc_id or past it; if one lands past it, that is the next candidate
+        target = rarest.advance(doc_id)
+        if target == doc_id:
+            for cursor in others:
+                if cursor.advance(doc_id) != doc_id:
+                    target = cursor.doc_id
+                    break
             else:
-                right = right_term
+                # Every term is in the document, now check their positions
+                if match_positions([cursors[term].positions() for term in terms], slop): result.append(doc_id)
+                target = doc_id + 1
 
-            eval_stack.append(list_operations.intersect(left, right))
+        if target is None: break # A term has no more documents
+        if doc_ids is None:
+            doc_id = target
+        else:
+            doc_id = next(doc_ids, None)
+            while doc_id is not None and doc_id < target: doc_id = next(doc_ids, None)
 
-        elif token == 'OR':
-            right_term = eval_stack.pop()
-            left_term = eval_stack.pop()
+    return result
 
-            left = []
-            right = []
-            if isinstance(left_term, str):
-                left = index_elimination(left_term, dictionary, N)
-            else:
-                left = left_term
-            
-            if isinstance(right_term, str):
-                right = index_elimination(right_term, dictionary, N)
-            else:
-                right = right_term
 
-            eval_stack.append(list_operations.union(left, right))
+def eval_rpn(rpn, dictionary, N, vsm_query):
+    # Kept for callers that evaluate an RPN directly; the planner gives the same result
+    return eval_plan(create_plan(rpn, dictionary, N), dictionary, N)
 
-        else:
-            pl = index_elimination(token, dictionary, N)
-            eval_stack.append(pl)
 
-    output = eval_stack.pop()
+# ========================================================================
+# QUERY PLANNER
+#
+# The RPN is turned into an expression tree before evaluation. Chains of the same
+# associative operator are flattened into one n-ary node, so a ten-term OR is a single
+# union_all instead of nine pairwise unions. Every node gets an estimated result size
+# from the dictionary's dfs: a term its df (0 if it is eliminated or unknown), a phrase
+# the smallest df of its terms, an AND the smallest estimate of its operands and an OR
+# the sum of them, capped at N. The operands of an AND are evaluated from the smallest
+# estimate up and the evaluation stops as soon as the intersection is empty, so a
+# rare term keeps the frequent ones from being read at all.
+
+class PlanNode:
+    def __init__(self, op, children=(), token=None):
+        self.op = op                  # 'TERM', 'PHRASE', 'AND' or 'OR'
+        self.children = list(children)
+        self.token = token            # The term, or the parsed phrase token
+        self.estimate = 0
+        self.actual = None            # Result size, once evaluated
+        self.seconds = None
+        self.note = None              # Why a term was not read in full, for explain_plan
+
+    def label(self):
+        if self.op == 'TERM': return self.token
+        if self.op == 'PHRASE':
+            terms, slop = phrase_terms(self.token)
+            return '"' + ' '.join(terms) + '"' + ('~' + str(slop) if slop else '')
+        return self.op
+
+
+def build_tree(rpn):
+    eval_stack = []
+    for token in rpn:
+        if isinstance(token, list):
+            if not token or isinstance(token[0], int): eval_stack.append(PlanNode('LIST', token=token))
+            else: eval_stack.append(PlanNode('PHRASE', token=token))
+
+        elif is_operator(token):
+            right = eval_stack.pop()
+            left = eval_stack.pop()
+
+            children = []
+            for child in (left, right):
+                # Flatten associative chains: (a AND b) AND c -> AND(a, b, c)
+                if child.op == token: children += child.children
+                else: children.append(child)
+            eval_stack.append(PlanNode(token, children))
 
-    return output
+        else:
+            eval_stack.append(PlanNode('TERM', token=token))
+
+    return eval_stack.pop()
+
+
+def estimate_plan(node, dictionary, N):
+    if node.op == 'TERM':
+        node.estimate = dictionary[node.token][2] if is_low_idf(node.token, dictionary, N) else 0
+        if node.token not in dictionary: node.note = 'not in dictionary'
+        elif node.estimate == 0: node.note = 'eliminated, df ' + str(dictionary[node.token][2])
+    elif node.op == 'LIST':
+        node.estimate = len(node.token)
+    elif node.op == 'PHRASE':
+        terms, _ = phrase_terms(node.token)
+        node.estimate = min((dictionary[term][2] if is_low_idf(term, dictionary, N) else 0 for term in terms), default=0)
+        unread = [term for term in terms if not is_low_idf(term, dictionary, N)]
+        if unread: node.note = 'eliminated or unknown: ' + ' '.join(unread)
+    else:
+        # A term repeated within one AND or OR does not change its result
+        seen = set()
+        children = []
+        for child in node.children:
+            if child.op == 'TERM':
+                if child.token in seen: continue
+                seen.add(child.token)
+            children.append(child)
+        node.children = children
+
+        for child in node.children: estimate_plan(child, dictionary, N)
+        node.children.sort(key=lambda child: child.estimate)
+        if node.op == 'AND':
+            node.estimate = node.children[0].estimate
+        else:
+            node.estimate = min(sum(child.estimate for child in node.children), N)
+
+
+def create_plan(rpn, dictionary, N):
+    plan = build_tree(rpn)
+    estimate_plan(plan, dictionary, N)
+    return plan
+
+
+def eval_plan(node, dictionary, N):
+    start = time.perf_counter()
+
+    if node.estimate == 0 and node.op != 'LIST':
+        # An eliminated or unknown term, or an AND with one: nothing to read
+        result = []
+    elif node.op == 'TERM':
+        result = file_operations.retrieve_doc_ids(node.token, dictionary)
+    elif node.op == 'LIST':
+        result = node.token
+    elif node.op == 'PHRASE':
+        result = eval_phrase(node.token, dictionary, N)
+    elif node.op == 'OR':
+        result = list_operations.union_all([eval_plan(child, dictionary, N) for child in node.children if child.estimate > 0])
+    else:
+        # Operands that can only be evaluated in full (ORs, lists) are gathered and
+        # intersected together by intersect_all, shortest first, before the next term
+        # or phrase filters the running intersection
+        result = eval_plan(node.children[0], dictionary, N)
+        operands = []
+        for child in node.children[1:]:
+            if operands and child.op in ('TERM', 'PHRASE'):
+                result = list_operations.intersect_all([result] + operands)
+                operands = []
+            if not result: break # Short-circuit: the remaining operands are never read
+            if child.op == 'TERM':
+                # Seek to the doc_ids found so far through the skip blocks instead of
+                # decoding the whole posting list
+                cursor = file_operations.PostingsCursor(child.token, dictionary)
+                result = [doc_id for doc_id in result if cursor.advance(doc_id) == doc_id]
+                child.actual = len(result)
+                child.note = 'probed with a cursor'
+            elif child.op == 'PHRASE':
+                # Only the documents found so far are checked for the phrase
+                child_start = time.perf_counter()
+                result = eval_phrase(child.token, dictionary, N, result)
+                child.actual = len(result)
+                child.seconds = time.perf_counter() - child_start
+                child.note = 'checked against the running intersection'
+            else:
+                operands.append(eval_plan(child, dictionary, N))
+                if not operands[-1]: result = []
+        if operands:
+            result = list_operations.intersect_all([result] + operands)
+
+    node.actual = len(result)
+    node.seconds = time.perf_counter() - start
+    return result
+
+
+def explain_plan(node, depth=0):
+    # One line per node: estimated and actual result sizes, and the time spent on it.
+    # Terms of an AND that were probed with a cursor report the size of the running
+    # intersection; operands skipped by a short-circuit are marked as not evaluated.
+    line = '  ' * depth + node.label() + '  est=' + str(node.estimate)
+    if node.actual is None:
+        line += '  (not evaluated)'
+    else:
+        line += '  actual=' + str(node.actual)
+        if node.seconds is not None: line += '  ' + '{:.3f}'.format(node.seconds * 1e3) + 'ms'
+    if node.note is not None: line += '  (' + node.note + ')'
+    lines = [line]
+    for child in node.children:
+        lines += explain_plan(child, depth + 1)
+    return lines
@@ -1,2 +1,23 @@
-SPIMI_BLOCK_SIZE = 256     # Maximum number of documents to store in each block
+SPIMI_BLOCK_SIZE = None    # Maximum number of documents to store in each block (None: only limited by the budget)
+SPIMI_MEMORY_BUDGET = 128 << 20 # Estimated bytes of in-memory postings per block; each worker inverts a block of its own
+POSTINGS_BYTES_PER_TOKEN = 160 # Estimated memory of one token's postings while a block is inverted
 NUM_WORKER_PROCESSES = 4
+MAX_MERGE_FAN_IN = 256     # Blocks merged at once, each with two files open; more are merged in passes
+INGEST_QUEUE_DEPTH = 2     # Mini blocks per worker that may wait or be in progress before the CSV reader pauses
+WORKER_INVERSION = True    # Workers invert their own slice and write it as a SPIMI run, instead of the parent
+POSTINGS_FORMAT = 4        # On-disk postings layout written by the indexer:
+                           #   1: absolute doc_ids and positions
+                           #   2: doc_id gaps within a posting list, position gaps within a document
+                           #   3: as 2, but each posting list is split into a doc_id gap and tf stream
+                           #      followed by a separate stream of all its position gaps
+                           #   4: as 3, followed by a skip stream over blocks of SKIP_BLOCK_SIZE postings
+SKIP_BLOCK_SIZE = 128      # Postings per skip block with postings format 4
+ON_DISK_DICTIONARY = False # Binary-search sorted text dictionaries in place on lookup instead of loading them
+FAST_TOKENIZER = True      # Split letters-only text on whitespace instead of running NLTK's tokenizers (same tokens)
+STEM_CACHE_SIZE = 1 << 16  # Maximum number of memoized stems per process
+ELIMINATION_THRESHOLD = 0.4 # Boolean queries drop terms found in at least this fraction of the documents
+POSTINGS_CACHE_SIZE = 1 << 20 # Maximum number of decoded postings numbers kept per query (0: no cache)
+SCORING_PROCESSES = 1       # Processes that share the VSM scoring of one query (1: score in the searching process)
+PARALLEL_SCORING_MIN_DOCS = 20000 # Queries with fewer documents to score are scored in a single process
+TOP_K = None               # Rank only this many boolean results per query (None: rank all of them)
+EXPLAIN_QUERIES = False    # Print the boolean query plan of every query, with estimated and actual list sizes
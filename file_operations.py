@@ -1,30 +1,532 @@
+import bisect
+import collections
+import glob
+import heapq
+import itertools as itt
+import json
+import mmap
 import os
+from array import array
 
-import vbcode as vb
+import vbcode_fast as vb
 
+import binary_index
+import config
 import filenames
 import language_operations
+import vsm
 
 
+FORMAT_HEADER = '#postings_format' # Header line of the dictionary file for postings formats >= 2
+SORTED_HEADER = '#sorted_terms'    # Header line of dictionary files whose terms are in sorted order
+postings_format = 1 # Format of the postings file being searched, set by load_dictionary
+tombstones = None   # Tombstones of the index being searched, set by load_dictionary; None if nothing is deleted
+DELETED = -1        # Live segment of a document deleted in every segment
+generation = 0      # Generation of the index files in use, set by init_search, init_update and init_indexing
+
 WORKING_DIR = os.getcwd()
 FILE_EXT = '.txt'
+WRITING_EXT = '.writing' # Suffix of index files being written, until they are moved over the old ones
+GENERATION_EXT = '.gen'  # Suffix of the index files of generation 1 and up, followed by the generation
 
 TMP_DIR = os.path.join(WORKING_DIR, 'tmp')
-if not os.path.exists(TMP_DIR): os.mkdir(TMP_DIR)
-
 TMP_DICT_DIR = os.path.join(TMP_DIR, 'dict')
 TMP_POST_DIR = os.path.join(TMP_DIR, 'post')
-if not os.path.exists(TMP_DICT_DIR): os.mkdir(TMP_DICT_DIR)
-if not os.path.exists(TMP_POST_DIR): os.mkdir(TMP_POST_DIR)
 
 
-def init_indexing(out_dict, out_post):
+def make_temp_dirs():
+    # Only processes that write SPIMI runs make the temp dirs, through init_indexing and
+    # init_update: flushing them deletes the runs of any indexer in the same working directory
+    if not os.path.exists(TMP_DIR): os.mkdir(TMP_DIR)
+    if not os.path.exists(TMP_DICT_DIR): os.mkdir(TMP_DICT_DIR)
+    if not os.path.exists(TMP_POST_DIR): os.mkdir(TMP_POST_DIR)
+
+
+class PostingsReader:
+    # Memory-maps the postings file once and hands out zero-copy views of the
+    # VB-encoded posting lists. The mapping is read-only, so processes forked after
+    # the reader is opened share the same pages instead of reopening the file.
+    def __init__(self, postings_file):
+        self.postings_file = postings_file
+        self.pf = open(postings_file, 'rb')
+
+        if os.fstat(self.pf.fileno()).st_size > 0:
+            self.mm = mmap.mmap(self.pf.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self.mm)
+        else:
+            # mmap cannot map an empty file
+            self.mm = None
+            self.view = memoryview(b'')
+
+        self.bytes_read = 0 # Total size of the views handed out, for reporting
+
+    def read(self, entry):
+        # entry: [seek_ptr, bytes_to_read, df, (max_wt, pos_seek_ptr, pos_bytes_to_read, (skip_seek_ptr, skip_bytes_to_read))]
+        # as stored in the dictionary. With postings format 3 and up this is only the doc_id and tf stream.
+        return self.read_bytes(entry[0], entry[1])
+
+    def read_positions(self, entry):
+        # The positions stream of a format 3 or 4 posting list
+        return self.read_bytes(entry[4], entry[5])
+
+    def read_skips(self, entry):
+        # The skip stream of a format 4 posting list, empty for short lists
+        return self.read_bytes(entry[6], entry[7])
+
+    def read_bytes(self, seek_ptr, bytes_to_read):
+        self.bytes_read += bytes_to_read
+        return self.view[seek_ptr:seek_ptr + bytes_to_read]
+
+    def close(self):
+        self.view.release()
+        if self.mm is not None: self.mm.close()
+        self.pf.close()
+
+
+postings_reader = None # Shared PostingsReader for filenames.postings_file
+
+
+def get_postings_reader():
+    global postings_reader
+    postings_file = index_file(filenames.postings_file)
+    if postings_reader is None or postings_reader.postings_file != postings_file:
+        close_postings_reader()
+        postings_reader = PostingsReader(postings_file)
+    return postings_reader
+
+
+def close_postings_reader():
+    global postings_reader, postings_cache
+    postings_cache = None # Its lists belong to the index being closed
+    if postings_reader is not None:
+        postings_reader.close()
+        postings_reader = None
+
+
+class PostingsCache:
+    # Decoded posting lists of the running query, shared by boolean evaluation, phrase
+    # matching and VSM scoring, so that a term's lists are decoded at most once per query.
+    # Bounded by the number of decoded numbers held: the least recently used lists are
+    # dropped once max_size is exceeded. Cached lists are handed out as they are and
+    # must not be modified.
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.lists = collections.OrderedDict()
+        # K: (kind, term)
+        # V: (decoded, size)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.low_idf = {} # Index elimination decision of every term looked up in this query
+
+    def get(self, key):
+        value = self.lists.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.lists.move_to_end(key)
+        return value[0]
+
+    def put(self, key, decoded, size):
+        if size > self.max_size: return decoded
+        self.lists[key] = (decoded, size)
+        self.size += size
+        while self.size > self.max_size:
+            _, (_, evicted_size) = self.lists.popitem(last=False)
+            self.size -= evicted_size
+        return decoded
+
+
+postings_cache = None # PostingsCache of the running query, set by start_query
+
+
+def start_query():
+    # Gives every query a fresh cache; lists are never shared between queries
+    global postings_cache
+    postings_cache = PostingsCache(config.POSTINGS_CACHE_SIZE) if config.POSTINGS_CACHE_SIZE > 0 else None
+    return postings_cache
+
+
+def cached(kind, term, decode):
+    # decode() through the running query's cache. decode returns (decoded, size), where
+    # size is the number of decoded numbers.
+    if postings_cache is None: return decode()[0]
+
+    key = (kind, term)
+    decoded = postings_cache.get(key)
+    if decoded is None: decoded = postings_cache.put(key, *decode())
+    return decoded
+
+
+class SortedTextDictionary:
+    # Read-only mapping of term -> [seek_ptr, bytes_to_read, df, (max_wt, ...)] over a sorted text
+    # dictionary file. The file is memory-mapped and binary-searched by byte offset
+    # on every lookup, so nothing is loaded up front.
+    def __init__(self, dict_file):
+        self.df = open(dict_file, 'rb')
+        self.mm = mmap.mmap(self.df.fileno(), 0, access=mmap.ACCESS_READ)
+        self.num_terms = None
+
+        # Header lines come before the first term
+        self.data_start = 0
+        while self.mm[self.data_start:self.data_start + 1] == b'#':
+            self.data_start = self.mm.find(b'\n', self.data_start) + 1
+
+    def find(self, term):
+        # Returns the dictionary line of term split into fields, or None
+        key = term.encode('utf-8')
+
+        low = self.data_start # Always the start of a line
+        high = len(self.mm)
+        while low < high:
+            mid = (low + high) // 2
+            newline = self.mm.rfind(b'\n', low, mid)
+            line_start = low if newline < 0 else newline + 1
+            line_end = self.mm.find(b'\n', line_start)
+            if line_end < 0: line_end = len(self.mm)
+
+            line = self.mm[line_start:line_end].split()
+            if line[0] == key:
+                return line
+            elif line[0] < key:
+                low = line_end + 1
+            else:
+                high = line_start
+        return None
+
+    def __contains__(self, term):
+        return isinstance(term, str) and self.find(term) is not None
+
+    def __getitem__(self, term):
+        line = self.find(term) if isinstance(term, str) else None
+        if line is None: raise KeyError(term)
+        return parse_dictionary_entry(line)
+
+    def get(self, term, default=None):
+        return self[term] if term in self else default
+
+    def __len__(self):
+        if self.num_terms is None: self.num_terms = sum(1 for _ in self)
+        return self.num_terms
+
+    def __iter__(self):
+        ptr = self.data_start
+        while ptr < len(self.mm):
+            line_end = self.mm.find(b'\n', ptr)
+            if line_end < 0: line_end = len(self.mm)
+            yield self.mm[ptr:self.mm.find(b' ', ptr)].decode('utf-8')
+            ptr = line_end + 1
+
+    def close(self):
+        self.mm.close()
+        self.df.close()
+
+
+class SegmentedEntry(list):
+    # Dictionary entry of a term in a segmented index: [None, None, df, (max_wt)], with the df
+    # summed and the max weight the highest over the segments holding the term. The
+    # segments' own entries are in .segments as (segment, entry), in segment order.
+    # It has no seek pointers of its own; the retrieve functions decode it segment by segment.
+    def __init__(self, segments):
+        entries = [entry for _, entry in segments]
+        super().__init__([None, None, sum(entry[2] for entry in entries)])
+        if all(len(entry) > 3 for entry in entries): self.append(max(entry[3] for entry in entries))
+        self.segments = segments
+
+
+class SegmentedDictionary:
+    # Read-only mapping of term -> SegmentedEntry over the dictionaries of the main index
+    # (segment 0) and of its delta segments. Their postings all live in the one postings
+    # file, so every segment's entries point into it.
+    # dead_dfs: {term: number of its deleted postings}, taken off its df; a term left
+    # with none is not in the dictionary
+    def __init__(self, segments, dead_dfs=None):
+        self.segments = segments
+        self.dead_dfs = dead_dfs or {}
+
+    def get(self, term, default=None):
+        found = []
+        for segment, dictionary in enumerate(self.segments):
+            entry = dictionary.get(term)
+            if entry is not None: found.append((segment, entry))
+        if not found: return default
+
+        entry = SegmentedEntry(found)
+        entry[2] -= self.dead_dfs.get(term, 0)
+        return entry if entry[2] > 0 else default
+
+    def __contains__(self, term):
+        return self.get(term) is not None
+
+    def __getitem__(self, term):
+        entry = self.get(term)
+        if entry is None: raise KeyError(term)
+        return entry
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __iter__(self):
+        terms = dict.fromkeys(itt.chain.from_iterable(self.segments))
+        if not self.dead_dfs: return iter(terms)
+        return (term for term in terms if term not in self.dead_dfs or term in self)
+
+    def close(self):
+        for dictionary in self.segments:
+            if hasattr(dictionary, 'close'): dictionary.close()
+
+
+def delta_dict_file(segment):
+    # Dictionary file of delta segment 1, 2, ... of the index at filenames.dict_file
+    return filenames.dict_file + '.delta' + str(segment)
+
+
+def delta_dict_files(gen=None):
+    # The delta segments appended to generation gen of the index so far (by default the one in
+    # use), in segment order. Like the names in filenames, these go through index_file.
+    delta_files = []
+    while os.path.exists(index_file(delta_dict_file(len(delta_files) + 1), gen)):
+        delta_files.append(delta_dict_file(len(delta_files) + 1))
+    return delta_files
+
+
+# ========================================================================
+# GENERATIONS
+#
+# Compacting an index replaces every one of its files at once: the main dictionary, postings
+# and lengths files, and its delta segments and tombstones, which the new main segment
+# already holds. The compacted files are therefore written as the next generation of the
+# index, under names of their own (see index_file), and published in one step by replacing
+# the generation file. Searchers read the generation file once, when they start, and open
+# every file of that generation. Generation 0 uses the names themselves, so an index that
+# was never compacted has no generation file.
+
+def index_file(path, gen=None):
+    # The file of generation gen (by default the one in use) of the index file named path:
+    # a name in filenames, or a delta_dict_file
+    if gen is None: gen = generation
+    return path if gen == 0 else path + GENERATION_EXT + str(gen)
+
+
+def read_generation():
+    # The generation of the index published last
+    if not os.path.exists(filenames.generation_file): return 0
+    with open(filenames.generation_file, 'r') as gf:
+        return int(gf.read())
+
+
+def publish_generation(gen):
+    # Makes searchers started from now on load generation gen of the index. The files of the
+    # generation published until now are kept for searchers still opening them, and removed
+    # at the next publication; those of any older generation are removed now.
+    global generation
+    prev_gen = read_generation()
+    if gen == 0:
+        if os.path.exists(filenames.generation_file): os.remove(filenames.generation_file)
+    else:
+        with open(filenames.generation_file + WRITING_EXT, 'w') as gf:
+            gf.write(str(gen) + '\n')
+        os.replace(filenames.generation_file + WRITING_EXT, filenames.generation_file)
+    generation = gen
+
+    for old_gen in index_generations():
+        if old_gen not in (gen, prev_gen): remove_generation(old_gen)
+
+
+def index_generations():
+    # The generations of the index with files left, found from their main dictionaries
+    gens = [0] if os.path.exists(filenames.dict_file) else []
+    for path in glob.glob(glob.escape(filenames.dict_file + GENERATION_EXT) + '*'):
+        suffix = path[len(filenames.dict_file + GENERATION_EXT):]
+        if suffix.isdigit(): gens.append(int(suffix))
+    return sorted(gens)
+
+
+def remove_generation(gen):
+    # Removes every file of generation gen of the index
+    names = [filenames.dict_file, filenames.postings_file, 'lengths.txt', filenames.lengths_bin_file,
+             filenames.deleted_file, filenames.dead_df_file] + delta_dict_files(gen)
+    for name in names:
+        if os.path.exists(index_file(name, gen)): os.remove(index_file(name, gen))
+
+
+class Tombstones:
+    # Documents deleted or updated since the index was last compacted, from the tombstone file:
+    # their sorted doc_ids, and for each the segment holding its live postings (DELETED if
+    # none). Postings of these documents in any other segment are deleted.
+    def __init__(self, doc_ids, live_segments, dead_dfs):
+        self.doc_ids = doc_ids             # array('q'), sorted
+        self.live_segments = live_segments # array('q')
+        self.dead_dfs = dead_dfs           # {term: number of its deleted postings, over all segments}
+        self.num_deleted = live_segments.count(DELETED)
+
+    def dead(self, segment, first_doc_id, last_doc_id):
+        # The sorted doc_ids from first_doc_id to last_doc_id whose postings in segment are deleted
+        start = bisect.bisect_left(self.doc_ids, first_doc_id)
+        end = bisect.bisect_right(self.doc_ids, last_doc_id, start)
+        return [self.doc_ids[i] for i in range(start, end) if self.live_segments[i] != segment]
+
+    def live_segment(self, doc_id, default=None):
+        i = bisect.bisect_left(self.doc_ids, doc_id)
+        return self.live_segments[i] if i < len(self.doc_ids) and self.doc_ids[i] == doc_id else default
+
+
+def load_tombstones():
+    # <doc id> <live segment>, sorted by doc id. None without a tombstone file, or an empty one.
+    # The dead df file next to it holds <term> <number of deleted postings>.
+    if not os.path.exists(index_file(filenames.deleted_file)): return None
+
+    doc_ids = array('q')
+    live_segments = array('q')
+    with open(index_file(filenames.deleted_file), 'r') as tf:
+        for li in tf:
+            line = li.split()
+            doc_ids.append(int(line[0]))
+            live_segments.append(int(line[1]))
+
+    dead_dfs = {}
+    if os.path.exists(index_file(filenames.dead_df_file)):
+        with open(index_file(filenames.dead_df_file), 'r') as ddf:
+            for li in ddf:
+                line = li.split()
+                dead_dfs[line[0]] = int(line[1])
+    return Tombstones(doc_ids, live_segments, dead_dfs) if doc_ids else None
+
+
+def write_tombstones(live_segments, dead_dfs=None):
+    # live_segments: {doc_id: live segment} of every deleted or updated document
+    # dead_dfs: {term: number of its deleted postings}
+    # Both files are written under temporary names and moved into place when complete
+    deleted_file = index_file(filenames.deleted_file)
+    dead_df_file = index_file(filenames.dead_df_file)
+    with open(dead_df_file + WRITING_EXT, 'w') as ddf:
+        for term in sorted(dead_dfs or {}):
+            ddf.write(term + ' ' + str(dead_dfs[term]) + '\n')
+    with open(deleted_file + WRITING_EXT, 'w') as tf:
+        for doc_id in sorted(live_segments):
+            tf.write(str(doc_id) + ' ' + str(live_segments[doc_id]) + '\n')
+    os.replace(dead_df_file + WRITING_EXT, dead_df_file)
+    os.replace(deleted_file + WRITING_EXT, deleted_file)
+
+
+def add_tombstones(doc_ids, live_segment):
+    # Records doc_ids as deleted everywhere but in live_segment (DELETED: deleted everywhere).
+    # The postings this deletes are counted per term, so that search can take them off the
+    # df of the term, as if the index had been rebuilt without them.
+    # filenames.dict_file must be the main index's dictionary.
+    loaded = load_tombstones()
+    live_segments = dict(zip(loaded.doc_ids, loaded.live_segments)) if loaded is not None else {}
+    dead_dfs = collections.Counter(loaded.dead_dfs if loaded is not None else {})
+
+    # Postings of a document without a tombstone are live in every segment, and those of a
+    # document with one only in its live segment
+    num_segments = 1 + len(delta_dict_files())
+    newly_dead = collections.defaultdict(list) # K: segment, V: doc_ids whose postings there are now deleted
+    for doc_id in sorted(set(doc_ids)):
+        prev_live_segment = live_segments.get(doc_id)
+        for segment in range(num_segments):
+            if segment != live_segment and (prev_live_segment is None or segment == prev_live_segment):
+                newly_dead[segment].append(doc_id)
+        live_segments[doc_id] = live_segment
+
+    dead_dfs.update(count_postings(newly_dead))
+    write_tombstones(live_segments, dead_dfs)
+
+
+def count_postings(segment_doc_ids):
+    # Number of postings of every term in the given documents, over the segments of the index.
+    # segment_doc_ids: {segment: sorted doc_ids}. Each term's cursor advances to the documents
+    # in turn, so only the skip blocks they fall in are read.
+    dict_files = [filenames.dict_file] + delta_dict_files()
+    counts = collections.Counter()
+    for segment, doc_ids in segment_doc_ids.items():
+        dictionary = load_dictionary_file(index_file(dict_files[segment]))
+        for term in dictionary:
+            cursor = PostingsCursor(term, dictionary)
+            for doc_id in doc_ids:
+                if cursor.advance(doc_id) is None: break
+                if cursor.doc_id == doc_id: counts[term] += 1
+        if hasattr(dictionary, 'close'): dictionary.close()
+    close_postings_reader()
+    return counts
+
+
+def deleted_postings(segment, doc_ids):
+    # Sorted indices of the deleted postings among those of segment with the sorted doc_ids.
+    # Each tombstone in their range is binary-searched, so a list is never walked for it,
+    # and without tombstones this is a single check.
+    if tombstones is None or not doc_ids: return []
+    deleted = []
+    for doc_id in tombstones.dead(segment, doc_ids[0], doc_ids[-1]):
+        i = bisect.bisect_left(doc_ids, doc_id)
+        if i < len(doc_ids) and doc_ids[i] == doc_id: deleted.append(i)
+    return deleted
+
+
+def drop_postings(li, deleted):
+    # li without the items at the sorted indices deleted, copied in runs between them
+    if not deleted: return li
+    kept = []
+    start = 0
+    for i in deleted:
+        kept += li[start:i]
+        start = i + 1
+    kept += li[start:]
+    return kept
+
+
+def is_deleted(doc_id):
+    return tombstones is not None and tombstones.live_segment(doc_id) == DELETED
+
+
+def init_indexing(out_dict, out_post, binary=False, gen=0):
+    # gen: the generation of the index to write, see index_file
+    global generation
+    make_temp_dirs() # May have been flushed by a previous run in this process
+    generation = gen
     filenames.dict_file = out_dict
     filenames.postings_file = out_post
-    filenames.lengths_file = 'lengths.txt'
+    filenames.lengths_file = filenames.lengths_bin_file if binary else 'lengths.txt'
+
+
+def init_update(out_dict, out_post):
+    # Prepares changing the existing index at out_dict and out_post, in its own postings
+    # format and kind of dictionary. Returns whether the index is binary.
+    global generation
+    make_temp_dirs()
+    filenames.dict_file = out_dict
+    filenames.postings_file = out_post
+    generation = read_generation()
+
+    binary = binary_index.is_binary_file(index_file(out_dict), binary_index.DICT_MAGIC)
+    if binary:
+        dictionary = binary_index.BinaryDictionary(index_file(out_dict))
+        config.POSTINGS_FORMAT = dictionary.postings_format
+        dictionary.close()
+        filenames.lengths_file = filenames.lengths_bin_file
+    else:
+        config.POSTINGS_FORMAT = load_dictionary_headers(index_file(out_dict)).get(FORMAT_HEADER, 1)
+        filenames.lengths_file = 'lengths.txt'
+    return binary
+
 
+def init_append(out_dict, out_post):
+    # Prepares indexing into a new delta segment of the index at out_dict and out_post.
+    # Returns the doc lengths of the documents already indexed, whether the index is
+    # binary, and the number of the new segment.
+    binary = init_update(out_dict, out_post)
+    lengths_map = load_lengths_map()
+    segment = len(delta_dict_files()) + 1
+    filenames.dict_file = delta_dict_file(segment)
+    return lengths_map, binary, segment
 
-def init_search(dict_file, postings_file, queries_file, results_file):
+
+def init_search(dict_file, postings_file, queries_file, results_file, gen=None):
+    # gen: the generation of the index to search, by default the one published last. Worker
+    # processes are handed their parent's, so that they search the same files.
+    global generation
+    generation = read_generation() if gen is None else gen
     filenames.dict_file = dict_file
     filenames.postings_file = postings_file
     filenames.lengths_file = 'lengths.txt'
@@ -33,31 +535,100 @@ def init_search(dict_file, postings_file, queries_file, results_file):
 
 
 def load_dictionary():
-    dictionary = {} # <term>: <seek ptr to posting> <bytes_to_read> <doc freq>
-    with open(filenames.dict_file, 'r') as df:
+    # The main index, and its delta segments if any were appended (see delta_dict_files).
+    # With tombstones, even a main index alone is read as segments, so that its deleted
+    # postings are filtered out.
+    global tombstones
+    tombstones = load_tombstones()
+    dictionary = load_dictionary_file(index_file(filenames.dict_file))
+    deltas = [load_dictionary_file(index_file(delta_file)) for delta_file in delta_dict_files()]
+    if not deltas and tombstones is None: return dictionary
+    return SegmentedDictionary([dictionary] + deltas, tombstones.dead_dfs if tombstones is not None else None)
+
+
+def load_dictionary_file(dict_file):
+    global postings_format
+
+    if binary_index.is_binary_file(dict_file, binary_index.DICT_MAGIC):
+        # Memory-mapped and binary-searched on lookup instead of being loaded
+        dictionary = binary_index.BinaryDictionary(dict_file)
+        postings_format = dictionary.postings_format
+        filenames.lengths_file = filenames.lengths_bin_file
+        return dictionary
+
+    headers = load_dictionary_headers(dict_file)
+    postings_format = headers.get(FORMAT_HEADER, 1) # Dictionaries without a format header point to absolute postings
+
+    if config.ON_DISK_DICTIONARY and headers.get(SORTED_HEADER):
+        return SortedTextDictionary(dict_file)
+
+    dictionary = {} # <term>: <seek ptr to posting> <bytes_to_read> <doc freq> (<max weight> (<positions seek ptr> <positions bytes_to_read>))
+    with open(dict_file, 'r') as df:
         for li in df:
             line = li.strip().split()
-            
-            dictionary[line[0]] = [int(line[1]), int(line[2]), int(line[3])]
+            if line[0][0] == '#': continue # header
+
+            dictionary[line[0]] = parse_dictionary_entry(line)
     return dictionary
 
 
+def parse_dictionary_entry(line):
+    # line: the fields of a dictionary line, term first.
+    # Dictionaries written before max weights were stored have only three numbers,
+    # only format 3 and 4 dictionaries point to a separate positions stream,
+    # and only format 4 dictionaries to a skip stream.
+    entry = [int(line[1]), int(line[2]), int(line[3])]
+    if len(line) > 4: entry.append(float(line[4]))
+    if len(line) > 5: entry += [int(line[5]), int(line[6])]
+    if len(line) > 7: entry += [int(line[7]), int(line[8])]
+    return entry
+
+
+def load_dictionary_headers(dict_file=None):
+    # Header lines at the top of a text dictionary, e.g. '#postings_format 2'
+    headers = {}
+    with open(dict_file or index_file(filenames.dict_file), 'r') as df:
+        for li in df:
+            if not li.startswith('#'): break
+            line = li.split()
+            headers[line[0]] = int(line[1])
+    return headers
+
+
 def load_doc_lengths():
+    # N leaves out the documents deleted by the tombstones of load_dictionary; they stay
+    # in the lengths file until the index is compacted
+    num_deleted = tombstones.num_deleted if tombstones is not None else 0
+    lengths_file = index_file(filenames.lengths_file)
+    if binary_index.is_binary_file(lengths_file, binary_index.LENGTHS_MAGIC):
+        lengths = binary_index.BinaryLengths(lengths_file)
+        return (lengths.N - num_deleted, lengths)
+
     lengths = {} # <doc id> <doc lengths squared>
     N = 0
-    lf = open(filenames.lengths_file, 'r')
+    lf = open(lengths_file, 'r')
     for li in lf:
         line = li.strip().split()
         if len(line) == 1: N = int(line[0])
         else: lengths[int(line[0])] = float(line[1])
 
     lf.close()
-    return (N, lengths)
+    return (N - num_deleted, lengths)
+
+
+def load_lengths_map():
+    # The doc lengths as a dict that can be added to, from either kind of lengths file
+    _, lengths = load_doc_lengths()
+    if isinstance(lengths, dict): return lengths
+
+    lengths_map = dict(zip(lengths.doc_ids.tolist(), lengths.lengths.tolist()))
+    lengths.close()
+    return lengths_map
 
 
-def read_query_file():
+def read_query_file(query_file=None):
     valid_docs = []
-    qf = open(filenames.query_file, 'r')
+    qf = open(query_file or filenames.query_file, 'r')
     q = [(line.strip()) for line in qf]
     qf.close()
 
@@ -67,12 +638,51 @@ def read_query_file():
     return query, valid_docs
 
 
+def read_query_batch(batch_file):
+    # Reads a batch of queries from either
+    #   - a directory of query files (same format as read_query_file), or
+    #   - a JSONL file with one {"id": ..., "query": ..., "relevant_docs": [...]} object per line
+    #     ("id" defaults to the line number and "relevant_docs" to none).
+    # Returns a list of (query_id, query, valid_docs). Query ids name the results files, so
+    # a ValueError is raised for a duplicate one, or one with a path separator in it.
+    queries = []
+
+    if os.path.isdir(batch_file):
+        for name in sorted(os.listdir(batch_file)):
+            query_file = os.path.join(batch_file, name)
+            if not os.path.isfile(query_file): continue # e.g. a subdirectory
+
+            query, valid_docs = read_query_file(query_file)
+            queries.append((os.path.splitext(name)[0], query, valid_docs))
+    else:
+        with open(batch_file, 'r') as bf:
+            for line_no, li in enumerate(bf, 1):
+                if not li.strip(): continue
+                q = json.loads(li)
+                queries.append((str(q.get('id', line_no)), q['query'], sorted(int(doc_id) for doc_id in q.get('relevant_docs', []))))
+
+    query_ids = set()
+    for query_id, _, _ in queries:
+        if query_id in ('', '.', '..') or '/' in query_id or '\\' in query_id:
+            raise ValueError(batch_file + ': query id ' + repr(query_id) + ' cannot name a results file')
+        if query_id in query_ids:
+            raise ValueError(batch_file + ': duplicate query id ' + repr(query_id))
+        query_ids.add(query_id)
+    return queries
+
+
 def retrieve_posting_list(term, dictionary):
-    # dictionary[term] : [seek_ptr, bytes_to_read, df]
+    if term not in dictionary: return {}
+    return cached('posting_list', term, lambda: decode_posting_list(dictionary[term]))
+
+
+def decode_posting_list(entry):
+    # entry : [seek_ptr, bytes_to_read, df, (max_wt, pos_seek_ptr, pos_bytes_to_read)]
     # postings file e.g. : [246391, 1, 30, 1587517, 1, 33, 1587784, 1, 34, 1620199, 2, 22551, 23322, 2125001, 2, 20, 119, 2125230, 2, 12, 97]
+    # or with gaps (format 2) : [246391, 1, 30, 1341126, 1, 33, 267, 1, 34, 32415, 2, 22551, 771, 504802, 2, 20, 99, 229, 2, 12, 85]
+    # or split in two streams (format 3) : [246391, 1, 1341126, 1, 267, 1, 32415, 2, 504802, 2, 229, 2]
+    #                                      [30, 33, 34, 22551, 771, 20, 99, 12, 85]
     
-    pf = open(filenames.postings_file, 'rb')
-
     postings = {}
     # A dictionary structure for the postings.
     # There will be df number of keys, with values as list with len tf, e.g.:
@@ -84,15 +694,21 @@ def retrieve_posting_list(term, dictionary):
     #    ...
     # }
 
-    if term in dictionary:
-        posting_seek_ptr = dictionary[term][0]
-        bytes_to_read = dictionary[term][1]
-        
-        pf.seek(posting_seek_ptr)
-        postings_encoded = pf.read(bytes_to_read)
-        postings_decoded = vb.decode(postings_encoded)
+    if isinstance(entry, SegmentedEntry):
+        # Every segment's live postings, merged in doc_id order
+        for segment, segment_entry in entry.segments:
+            segment_postings, _ = decode_posting_list(segment_entry)
+            doc_ids = list(segment_postings)
+            for i in deleted_postings(segment, doc_ids): del segment_postings[doc_ids[i]]
+            postings.update(segment_postings)
+        postings = dict(sorted(postings.items(), key=lambda posting: posting[0]))
+        return postings, len(postings) + sum(len(positions) for positions in postings.values())
 
-        ptr = 0
+    postings_encoded = get_postings_reader().read(entry)
+    postings_decoded = vb.decode(postings_encoded)
+
+    ptr = 0
+    if postings_format == 1:
         while ptr < len(postings_decoded):
             doc_id = postings_decoded[ptr]
             ptr += 1
@@ -100,21 +716,306 @@ def retrieve_posting_list(term, dictionary):
             ptr += 1
             postings[doc_id] = postings_decoded[ptr:ptr + tf]
             ptr += tf
-    
-    pf.close()
+    elif postings_format == 2:
+        doc_id = 0
+        while ptr < len(postings_decoded):
+            doc_id += postings_decoded[ptr]
+            ptr += 1
+            tf = postings_decoded[ptr]
+            ptr += 1
+            postings[doc_id] = list(itt.accumulate(postings_decoded[ptr:ptr + tf]))
+            ptr += tf
+    else:
+        positions_decoded = vb.decode(get_postings_reader().read_positions(entry))
+        doc_id = 0
+        for i in range(0, len(postings_decoded), 2):
+            doc_id += postings_decoded[i]
+            tf = postings_decoded[i + 1]
+            postings[doc_id] = list(itt.accumulate(positions_decoded[ptr:ptr + tf]))
+            ptr += tf
 
-    return postings
+    return postings, len(postings) + sum(len(positions) for positions in postings.values())
     # K: doc_id
     # V: [pos_idx]
 
 
-def write_results(sorted_scores):
-    rf = open(filenames.results_file, 'w')
+def decode_postings(term, dictionary):
+    # The doc_ids of a term's posting list and their tfs, as two lists,
+    # without building the lists of positions (or reading them, with format 3 and up)
+    if term not in dictionary: return [], []
+    return cached('postings', term, lambda: decode_doc_ids_and_tfs(dictionary[term]))
+
+
+def decode_doc_ids_and_tfs(entry):
+    if isinstance(entry, SegmentedEntry):
+        # Every segment's live postings, merged in doc_id order. Documents appended later
+        # usually come after those already indexed, and the sort then only checks the order.
+        postings = []
+        for segment, segment_entry in entry.segments:
+            (doc_ids, tfs), _ = decode_doc_ids_and_tfs(segment_entry)
+            deleted = deleted_postings(segment, doc_ids)
+            doc_ids = drop_postings(doc_ids, deleted)
+            tfs = drop_postings(tfs, deleted)
+            if len(entry.segments) == 1: return (doc_ids, tfs), 2 * len(doc_ids)
+            postings += zip(doc_ids, tfs)
+        postings.sort(key=lambda posting: posting[0])
+        return ([doc_id for doc_id, _ in postings], [tf for _, tf in postings]), 2 * len(postings)
+
+    postings_decoded = vb.decode(get_postings_reader().read(entry))
+
+    if postings_format >= 3:
+        doc_ids = list(itt.accumulate(postings_decoded[0::2]))
+        tfs = postings_decoded[1::2]
+    else:
+        doc_ids = []
+        tfs = []
+        ptr = 0
+        doc_id = 0
+        while ptr < len(postings_decoded):
+            if postings_format == 1:
+                doc_id = postings_decoded[ptr]
+            else:
+                doc_id += postings_decoded[ptr]
+            tf = postings_decoded[ptr + 1]
+            doc_ids.append(doc_id)
+            tfs.append(tf)
+            ptr += 2 + tf
+
+    return (doc_ids, tfs), 2 * len(doc_ids)
+
+
+def decode_positions(term, dictionary):
+    # The position gaps of every document of a format 3 or 4 posting list, in one list,
+    # and the index in it where each document's positions start
+    def decode():
+        _, tfs = decode_postings(term, dictionary)
+        position_gaps = decode_position_gaps(dictionary[term])
+        starts = list(itt.accumulate(tfs, initial=0))
+        return (position_gaps, starts), len(position_gaps) + len(starts)
+    return cached('positions', term, decode)
+
+
+def decode_position_gaps(entry):
+    if isinstance(entry, SegmentedEntry):
+        # Each live document's position gaps, in the doc_id order of decode_doc_ids_and_tfs
+        documents = []
+        for segment, segment_entry in entry.segments:
+            (doc_ids, tfs), _ = decode_doc_ids_and_tfs(segment_entry)
+            position_gaps = decode_position_gaps(segment_entry)
+            starts = itt.accumulate(tfs, initial=0)
+            segment_documents = [(doc_id, position_gaps[start:start + tf]) for doc_id, tf, start in zip(doc_ids, tfs, starts)]
+            documents += drop_postings(segment_documents, deleted_postings(segment, doc_ids))
+        documents.sort(key=lambda document: document[0])
+        return list(itt.chain.from_iterable(position_gaps for _, position_gaps in documents))
+
+    return vb.decode(get_postings_reader().read_positions(entry))
+
+
+def decode_documents(entry):
+    # Every document of a posting list as (doc_id, (tf, [pos_idx])), in doc_id order:
+    # the form write_block takes, to write an index back out as a SPIMI run
+    if postings_format < 3:
+        postings, _ = decode_posting_list(entry)
+        return [(doc_id, (len(positions), positions)) for doc_id, positions in postings.items()]
+
+    (doc_ids, tfs), _ = decode_doc_ids_and_tfs(entry)
+    position_gaps = decode_position_gaps(entry)
+    starts = itt.accumulate(tfs, initial=0)
+    return [(doc_id, (tf, list(itt.accumulate(position_gaps[start:start + tf]))))
+            for doc_id, tf, start in zip(doc_ids, tfs, starts)]
+
+
+def retrieve_term_frequencies(term, dictionary):
+    # Like retrieve_posting_list, but only maps each doc_id to its tf
+    if term not in dictionary: return {}
+    def decode():
+        doc_ids, tfs = decode_postings(term, dictionary)
+        return dict(zip(doc_ids, tfs)), len(doc_ids)
+    return cached('tfs', term, decode)
+    # K: doc_id
+    # V: tf
+
+
+def retrieve_doc_ids(term, dictionary):
+    # The sorted doc_ids of a term's posting list
+    return decode_postings(term, dictionary)[0]
+
+
+class PostingsCursor:
+    # Iterates over the posting list of a term one document at a time, in doc_id order.
+    #   doc_id: the current doc_id, or None once the list is exhausted
+    #   tf: the current tf
+    #   next(): moves to the next document
+    #   advance(target): moves to the first document with doc_id >= target
+    #   positions(): the positions of the current document
+    #   take_block(): the rest of the current block, then moves to the next block
+    # With postings format 4, the skip stream splits the list into blocks of
+    # config.SKIP_BLOCK_SIZE postings; a block is only read and decoded once the cursor
+    # enters it, and its positions only when they are asked for. Lists without skips, and
+    # lists the running query has already decoded in full, are walked as a single block
+    # through the postings cache. In a segmented index, the segments' lists are walked one
+    # after the other when their doc_ids follow each other, and as one merged list if not.
+    def __init__(self, term, dictionary):
+        self.term = term
+        self.dictionary = dictionary
+        self.entry = dictionary.get(term)
+        self.last_doc_ids = [] # Last doc_id of every block
+        self.blocks = []       # (seek_ptr, bytes_to_read, pos_seek_ptr, pos_bytes_to_read, prev_doc_id, segment) of every
+                               # block, or None for the single block of a whole list
+
+        if self.entry is None:
+            pass
+        elif postings_format < 3:
+            # Positions are interleaved with the doc_ids, decode everything up front
+            self.postings = retrieve_posting_list(term, dictionary)
+            self.last_doc_ids = [next(reversed(self.postings))] if self.postings else []
+            self.blocks = [None] * len(self.last_doc_ids)
+        elif (postings_format >= 4 and (postings_cache is None or ('postings', term) not in postings_cache.lists)
+              and self.load_skips()):
+            pass
+        else:
+            doc_ids, _ = decode_postings(term, dictionary)
+            self.last_doc_ids = doc_ids[-1:]
+            self.blocks = [None] * len(self.last_doc_ids)
+
+        self.block = -1
+        self.doc_id = None
+        self.tf = 0
+        self.load_block(0)
+
+    def load_skips(self):
+        # Fills in the blocks of the list from its skip stream, or of every segment's list in
+        # turn. Returns False, with nothing filled in, if there are no skips to use or the
+        # segments' doc_ids overlap.
+        segment_entries = self.entry.segments if isinstance(self.entry, SegmentedEntry) else [(0, self.entry)]
+        if all(entry[7] == 0 for _, entry in segment_entries): return False
+
+        reader = get_postings_reader()
+        last_doc_ids = []
+        blocks = []
+        for segment, entry in segment_entries:
+            if last_doc_ids:
+                # A segment's first doc_id is stored as is, as a gap from 0
+                first_doc_id, _ = binary_index.read_vb(reader.view, entry[0])
+                if first_doc_id <= last_doc_ids[-1]: return False
+
+            if entry[7] > 0:
+                skips = vb.decode(reader.read_skips(entry))
+                segment_last_doc_ids = list(itt.accumulate(skips[0::3]))
+                seek_ptrs = itt.accumulate(skips[1::3], initial=entry[0])
+                pos_seek_ptrs = itt.accumulate(skips[2::3], initial=entry[4])
+                prev_doc_ids = [0] + segment_last_doc_ids[:-1] # Gaps carry on from the last doc_id of the previous block
+                blocks += zip(seek_ptrs, skips[1::3], pos_seek_ptrs, skips[2::3], prev_doc_ids, itt.repeat(segment))
+            else:
+                # A short list is a single block
+                (doc_ids, _), _ = decode_doc_ids_and_tfs(entry)
+                segment_last_doc_ids = doc_ids[-1:]
+                blocks.append((entry[0], entry[1], entry[4], entry[5], 0, segment))
+            last_doc_ids += segment_last_doc_ids
+
+        self.last_doc_ids = last_doc_ids
+        self.blocks = blocks
+        return True
+
+    def load_block(self, block):
+        self.ptr = 0
+        self.block_positions = None
+
+        while True:
+            self.block = block
+            self.block_position_starts = None
+
+            if block >= len(self.blocks):
+                self.block_doc_ids = []
+                self.doc_id = None
+                return
+
+            if postings_format < 3:
+                self.block_doc_ids = list(self.postings)
+                self.block_tfs = [len(positions) for positions in self.postings.values()]
+            elif self.blocks[block] is None:
+                self.block_doc_ids, self.block_tfs = decode_postings(self.term, self.dictionary)
+            else:
+                seek_ptr, bytes_to_read, _, _, prev_doc_id, segment = self.blocks[block]
+                postings_decoded = vb.decode(get_postings_reader().read_bytes(seek_ptr, bytes_to_read))
+                self.block_doc_ids = list(itt.accumulate(postings_decoded[0::2], initial=prev_doc_id))[1:]
+                self.block_tfs = postings_decoded[1::2]
+
+                deleted = deleted_postings(segment, self.block_doc_ids)
+                if deleted:
+                    # Deleted postings are dropped; each live document's positions still
+                    # start where they do in the block's positions stream
+                    starts = list(itt.accumulate(self.block_tfs, initial=0))
+                    self.block_position_starts = drop_postings(starts, deleted)
+                    self.block_doc_ids = drop_postings(self.block_doc_ids, deleted)
+                    self.block_tfs = drop_postings(self.block_tfs, deleted)
+
+            if self.block_doc_ids: break
+            block += 1 # Every posting of the block is deleted
+
+        self.doc_id = self.block_doc_ids[0] if self.block_doc_ids else None
+        self.tf = self.block_tfs[0] if self.block_doc_ids else 0
+
+    def next(self):
+        if self.doc_id is None: return None
+
+        self.ptr += 1
+        if self.ptr < len(self.block_doc_ids):
+            self.doc_id = self.block_doc_ids[self.ptr]
+            self.tf = self.block_tfs[self.ptr]
+        else:
+            self.load_block(self.block + 1)
+        return self.doc_id
+
+    def advance(self, target):
+        if self.doc_id is None or self.doc_id >= target: return self.doc_id
+
+        while target > self.block_doc_ids[-1]:
+            # Skip every block that ends before target without reading it. A block can
+            # end before target once its deleted postings are dropped, so this may repeat.
+            block = bisect.bisect_left(self.last_doc_ids, target, self.block + 1)
+            self.load_block(block)
+            if self.doc_id is None or self.doc_id >= target: return self.doc_id
+
+        self.ptr = bisect.bisect_left(self.block_doc_ids, target, self.ptr)
+        self.doc_id = self.block_doc_ids[self.ptr]
+        self.tf = self.block_tfs[self.ptr]
+        return self.doc_id
+
+    def take_block(self):
+        # The doc_ids and tfs from the current document to the end of its block
+        if self.doc_id is None: return [], []
+
+        doc_ids = self.block_doc_ids[self.ptr:]
+        tfs = self.block_tfs[self.ptr:]
+        self.load_block(self.block + 1)
+        return doc_ids, tfs
+
+    def positions(self):
+        if self.doc_id is None: return []
+        if postings_format < 3: return self.postings[self.doc_id]
+
+        if self.block_positions is None:
+            if self.blocks[self.block] is None:
+                self.block_positions, self.block_position_starts = decode_positions(self.term, self.dictionary)
+            else:
+                _, _, pos_seek_ptr, pos_bytes_to_read, _, _ = self.blocks[self.block]
+                self.block_positions = vb.decode(get_postings_reader().read_bytes(pos_seek_ptr, pos_bytes_to_read))
+                if self.block_position_starts is None:
+                    self.block_position_starts = list(itt.accumulate(self.block_tfs, initial=0))
+
+        start = self.block_position_starts[self.ptr]
+        return list(itt.accumulate(self.block_positions[start:start + self.tf]))
+
+
+def write_results(sorted_scores, results_file=None):
+    rf = open(results_file or filenames.results_file, 'w')
     rf.write(' '.join([str(doc_id) for doc_id, score in sorted_scores]))
     rf.close()
 
 
-def write_block(block_id, doc_id_map, block_map, lengths_map):
+def write_block(block_id, doc_id_map, lengths_map):
+    # Returns the block's size statistics: (num_docs, num_tokens, num_terms, bytes_written)
     print('Writing block', block_id)
     term_map = language_operations.get_term_postings(doc_id_map) # The final dictionary containing term - doc_id mappings
 
@@ -136,99 +1037,393 @@ def write_block(block_id, doc_id_map, block_map, lengths_map):
     #         Element 1: doc_length_squared
 
     posting_seek_ptr = 0 # to be written to dict file
-    dict_seek_ptr = 0 # to be written to block mapping
 
     bdf = open(block_dict, 'w')
     bpf = open(block_postings, 'wb')
-    
-    for term in term_map:
+
+    postings = bytearray()  # VB-encoded postings of the current term, reused across terms
+    positions = bytearray() # Its positions stream, with postings format 3
+
+    # Terms are written in sorted order, so blocks can be merged sequentially
+    for term in sorted(term_map):
         df = term_map[term][0]
 
-        postings = term
-        for document in term_map[term][1]:
-            doc_id = document[0]
-            tf = document[1][0]
-            position_indices = document[1][1]
+        postings.clear()
+        positions.clear()
+        last_doc_id = encode_term_postings(postings, term_map[term][1], positions)
+        bpf.write(postings)
+        bpf.write(positions)
 
-            postings = postings + ' ' + str(doc_id) + ' ' + str(tf)
+        # Highest normalized document weight of the term, an upper bound for top-k scoring
+        max_wt = max(vsm.compute_doc_weight(tf, doc_id_map[doc_id][1]) for doc_id, (tf, _) in term_map[term][1])
 
-            for index in position_indices:
-                postings = postings + (' ' + str(index))
+        posting_bytes_to_read = len(postings)
+        bdf.write(term + ' ' + str(posting_seek_ptr) + ' ' + str(posting_bytes_to_read) + ' ' + str(df) + ' '
+                  + str(last_doc_id) + ' ' + str(max_wt) + ' ' + str(len(positions)) + '\n')
+        posting_seek_ptr += posting_bytes_to_read + len(positions)
 
-        # Apply VB encoding to postings list, then write to file
-        bpf.write(vb.encode([int(num) for num in postings.split()[1:]]))
+    for doc_id in sorted(doc_id_map):
+        lengths_map[doc_id] = doc_id_map[doc_id][1]
 
-        # ADD TO BLOCK MAP
-        if term in block_map:
-            block_map[term].append((block_id, dict_seek_ptr))
-        else:
-            block_map[term] = [(block_id, dict_seek_ptr)]
+    bytes_written = bpf.tell() + bdf.tell()
+    bpf.close()
+    bdf.close()
 
-        posting_bytes_to_read = bpf.tell() - posting_seek_ptr
-        bdf.write(term + ' ' + str(posting_seek_ptr) + ' ' + str(posting_bytes_to_read) + ' ' + str(df) + '\n')
-        posting_seek_ptr = bpf.tell()
+    num_tokens = sum(tf for doc_terms, _ in doc_id_map.values() for tf, _ in doc_terms.values())
+    print('Block', block_id, 'written:', len(doc_id_map), 'documents,', num_tokens, 'tokens,',
+          len(term_map), 'terms,', bytes_written, 'bytes')
+    return len(doc_id_map), num_tokens, len(term_map), bytes_written
 
-        dict_seek_ptr = bdf.tell()
 
-    for doc_id in sorted(doc_id_map):
-        lengths_map[doc_id] = doc_id_map[doc_id][1]
+def write_segments_run(run_id, dictionary, lengths_map):
+    # Writes every posting list of the index open in dictionary, over all of its segments,
+    # out as a single SPIMI run, which merge_blocks then turns back into a one-segment index.
+    # Lists are decoded and written one term at a time. Deleted postings are left out, and
+    # so are terms with nothing else.
+    print('Writing run', run_id)
+    run_dict = os.path.join(TMP_DICT_DIR, str(run_id) + FILE_EXT)
+    run_postings = os.path.join(TMP_POST_DIR, str(run_id) + FILE_EXT)
+
+    posting_seek_ptr = 0
+
+    bdf = open(run_dict, 'w')
+    bpf = open(run_postings, 'wb')
+
+    postings = bytearray()
+    positions = bytearray()
+
+    for term in sorted(dictionary):
+        documents = decode_documents(dictionary[term])
+        if not documents: continue
+
+        postings.clear()
+        positions.clear()
+        last_doc_id = encode_term_postings(postings, documents, positions)
+        bpf.write(postings)
+        bpf.write(positions)
+
+        max_wt = max(vsm.compute_doc_weight(tf, lengths_map[doc_id]) for doc_id, (tf, _) in documents)
+
+        bdf.write(term + ' ' + str(posting_seek_ptr) + ' ' + str(len(postings)) + ' ' + str(len(documents)) + ' '
+                  + str(last_doc_id) + ' ' + str(max_wt) + ' ' + str(len(positions)) + '\n')
+        posting_seek_ptr += len(postings) + len(positions)
 
     bpf.close()
     bdf.close()
 
 
-def merge_blocks(block_map, lengths_map):
+def encode_term_postings(buf, documents, pos_buf=None):
+    # Appends the VB-encoded postings of one term straight to the bytearray buf,
+    # without building an intermediate string. Returns the last doc_id.
+    # With postings format 3, buf only gets the doc_id gaps and tfs, and the position
+    # gaps go to the bytearray pos_buf.
+    # documents: [  Element 0: doc_id
+    #               Element 1: (tf, [pos_idx]) ]
+    encode_into = vb.encode_into
+    prev_doc_id = 0
+
+    for doc_id, (tf, position_indices) in documents:
+        if config.POSTINGS_FORMAT >= 3:
+            encode_into(buf, doc_id - prev_doc_id)
+            encode_into(buf, tf)
+
+            prev_index = 0
+            for index in position_indices:
+                encode_into(pos_buf, index - prev_index)
+                prev_index = index
+        elif config.POSTINGS_FORMAT == 1:
+            encode_into(buf, doc_id)
+            encode_into(buf, tf)
+            for index in position_indices:
+                encode_into(buf, index)
+        else:
+            # Gaps are taken from the previous doc_id in the block, and from the
+            # previous position in the document
+            encode_into(buf, doc_id - prev_doc_id)
+            encode_into(buf, tf)
+
+            prev_index = 0
+            for index in position_indices:
+                encode_into(buf, index - prev_index)
+                prev_index = index
+        prev_doc_id = doc_id
+
+    return prev_doc_id
+
+
+def merge_blocks(block_ids, lengths_map, binary=False, append=False, superseded=None):
+    # K-way merge of the sorted block files into the index, see merge_run_terms.
+    # append: the merged postings go to the end of the existing postings file, for a delta
+    # segment, and lengths_map must hold the documents of every segment
+    # The dictionary and lengths files are written under temporary names and moved over the
+    # old ones when complete, the lengths first: a searcher starting meanwhile never loads a
+    # partial file, or a dictionary with documents that have no lengths yet. Appended
+    # postings are only pointed to once the new dictionary is in place.
     print('Merging blocks...')
-    mdf = open(filenames.dict_file, 'w')
-    mpf = open(filenames.postings_file, 'wb')
-    mlf = open(filenames.lengths_file, 'w')
-    mpf_seek_ptr = 0
-
-    for term in block_map:
-        master_term_df = 0
-        master_posting = b''
-
-        for block in block_map[term]:
-            # e.g. -> block_map[term]: [(1, 0),(2, 400672),(3, 508304),(4, 272944),(5, 533311),(6, 646261),(7, 207529),(8, 79541),...]
-            term_block_id = block[0]
-            bdf_seek_ptr = int(block[1])
-
-            block_dict = os.path.join(TMP_DICT_DIR, str(block[0]) + FILE_EXT)
-            block_postings = os.path.join(TMP_POST_DIR, str(block[0]) + FILE_EXT)
-            bdf = open(block_dict, 'r')
-            bpf = open(block_postings, 'rb')
-
-            bdf.seek(bdf_seek_ptr) # seek to position of term in block file
-            term_dict = bdf.readline().split() # e.g.: anoth 63078 2324 182
-
-            bpf_seek_ptr = int(term_dict[1])
-            bpf_bytes_to_read = int(term_dict[2])
-            term_df = int(term_dict[3])
-            master_term_df += term_df
-
-            bpf.seek(bpf_seek_ptr)
-            master_posting = master_posting + bpf.read(bpf_bytes_to_read)
-            
-            bpf.close()
-            bdf.close()
-        
-        mpf.write(master_posting)
-
-        mpf_bytes_to_read = mpf.tell() - mpf_seek_ptr
-        mdf.write(term + ' ' + str(mpf_seek_ptr) + ' ' + str(mpf_bytes_to_read) + ' ' + str(master_term_df) + '\n')
+
+    # Every block being merged holds two files open, so at most config.MAX_MERGE_FAN_IN
+    # blocks are merged at once. With more, consecutive groups of them are first merged
+    # into intermediate runs, in passes, until few enough are left.
+    fan_in = max(2, config.MAX_MERGE_FAN_IN)
+    run_id = max(block_ids, default=0)
+    while len(block_ids) > fan_in:
+        print('Merging', len(block_ids), 'blocks in groups of', fan_in)
+        run_ids = []
+        for start in range(0, len(block_ids), fan_in):
+            group = block_ids[start:start + fan_in]
+            run_id += 1
+            write_merged_run(run_id, merge_run_terms(group, lengths_map, superseded))
+            remove_runs(group)
+            run_ids.append(run_id)
+        block_ids = run_ids
+        superseded = None # Only the last version of every document is left after the first pass
+
+    dict_file = index_file(filenames.dict_file)
+    lengths_file = index_file(filenames.lengths_file)
+    mpf = open(index_file(filenames.postings_file), 'ab' if append else 'wb')
+    mpf_seek_ptr = mpf.tell()
+
+    if binary:
+        dictionary_entries = [] # (term, seek_ptr, bytes_to_read, df, max_wt, ...) as in the dictionary, written out sorted at the end
+    else:
+        mdf = open(dict_file + WRITING_EXT, 'w')
+        if config.POSTINGS_FORMAT != 1:
+            mdf.write(FORMAT_HEADER + ' ' + str(config.POSTINGS_FORMAT) + '\n')
+        mdf.write(SORTED_HEADER + ' 1\n')
+
+    for term, postings, positions, df, _, max_wt in merge_run_terms(block_ids, lengths_map, superseded):
+        mpf.write(postings)
+        entry = [mpf_seek_ptr, len(postings), df, max_wt]
+        if config.POSTINGS_FORMAT >= 3:
+            # The positions streams of the runs follow the merged postings, as they are:
+            # positions are gaps within each document
+            entry += [mpf.tell(), len(positions)]
+            mpf.write(positions)
+        if config.POSTINGS_FORMAT >= 4:
+            skips = encode_skips(postings, positions)
+            entry += [mpf.tell(), len(skips)]
+            mpf.write(skips)
+
+        if binary:
+            dictionary_entries.append((term, *entry))
+        else:
+            mdf.write(term + ' ' + ' '.join(str(field) for field in entry) + '\n')
         mpf_seek_ptr = mpf.tell()
 
-    N = len(lengths_map.keys())
-    mlf.write(str(N) + '\n')
-    for doc_id in lengths_map:
-        mlf.write(str(doc_id) + ' ' + str(lengths_map[doc_id]) + '\n')
-        
-    mdf.close()
     mpf.close()
-    mlf.close()
+
+    N = len(lengths_map.keys())
+    if binary:
+        binary_index.write_dictionary(dict_file + WRITING_EXT, dictionary_entries, config.POSTINGS_FORMAT)
+        binary_index.write_lengths(lengths_file + WRITING_EXT, N, lengths_map)
+    else:
+        mdf.close()
+
+        mlf = open(lengths_file + WRITING_EXT, 'w')
+        mlf.write(str(N) + '\n')
+        for doc_id in lengths_map:
+            mlf.write(str(doc_id) + ' ' + str(lengths_map[doc_id]) + '\n')
+        mlf.close()
+
+    os.replace(lengths_file + WRITING_EXT, lengths_file)
+    os.replace(dict_file + WRITING_EXT, dict_file)
+
+
+def merge_run_terms(block_ids, lengths_map, superseded=None):
+    # Merges the sorted block files of block_ids, in merge order, one term at a time.
+    # Every block is read sequentially through one open dictionary and postings file,
+    # and a heap holds the next term of each block, so memory is bounded by the
+    # number of blocks rather than the number of terms.
+    # Yields (term, postings, positions, df, last_doc_id, max_wt) for every term in sorted
+    # order, its postings and positions streams laid out as in a block file.
+    # superseded: {doc_id: block_id} of the documents found in more than one block, and the
+    # block holding the last version of each; their postings from other blocks are dropped
+    superseded_doc_ids = sorted(superseded) if superseded else []
+
+    block_files = [] # (bdf, bpf) for every block, in merge order
+    heap = [] # (term, block_idx, term_dict) for the next unmerged term of every block
+
+    for block_id in block_ids:
+        bdf = open(os.path.join(TMP_DICT_DIR, str(block_id) + FILE_EXT), 'r')
+        bpf = open(os.path.join(TMP_POST_DIR, str(block_id) + FILE_EXT), 'rb')
+        block_files.append((bdf, bpf))
+        push_next_block_term(heap, len(block_files) - 1, bdf)
+
+    while heap:
+        term = heap[0][0]
+        parts = [] # (block_id, term_dict, postings, positions) of every block holding the term
+
+        # Blocks holding the same term pop off the heap in merge order
+        while heap and heap[0][0] == term:
+            _, block_idx, term_dict = heapq.heappop(heap) # term_dict e.g.: anoth 63078 1060 182 1587784 0.0806 1264
+            bdf, bpf = block_files[block_idx]
+
+            # Postings are stored in the same order as the dictionary, so no seek is needed
+            block_posting = bpf.read(int(term_dict[2]))
+            block_positions = bpf.read(int(term_dict[6]))
+            parts.append((block_ids[block_idx], term_dict, block_posting, block_positions))
+            push_next_block_term(heap, block_idx, bdf)
+
+        if in_doc_id_order(parts, superseded_doc_ids):
+            yield (term, *concat_run_postings(parts))
+            continue
+
+        # Documents repeated across blocks, or blocks out of doc_id order: the term's list is
+        # decoded, sorted and encoded again, with only the last version of every document
+        documents = {}
+        for block_id, _, block_posting, block_positions in parts:
+            for doc_id, document in decode_run_documents(block_posting, block_positions):
+                if superseded is None or superseded.get(doc_id, block_id) == block_id: documents[doc_id] = document
+        if not documents: continue # Only in versions replaced since
+
+        documents = sorted(documents.items(), key=lambda document: document[0])
+        postings = bytearray()
+        positions = bytearray()
+        last_doc_id = encode_term_postings(postings, documents, positions)
+        max_wt = max(vsm.compute_doc_weight(tf, lengths_map[doc_id]) for doc_id, (tf, _) in documents)
+        yield term, postings, positions, len(documents), last_doc_id, max_wt
+
+    for bdf, bpf in block_files:
+        bdf.close()
+        bpf.close()
+
+
+def write_merged_run(run_id, terms):
+    # Writes the merged terms of merge_run_terms out as a block file again
+    run_dict = os.path.join(TMP_DICT_DIR, str(run_id) + FILE_EXT)
+    run_postings = os.path.join(TMP_POST_DIR, str(run_id) + FILE_EXT)
+
+    posting_seek_ptr = 0
+
+    bdf = open(run_dict, 'w')
+    bpf = open(run_postings, 'wb')
+
+    for term, postings, positions, df, last_doc_id, max_wt in terms:
+        bpf.write(postings)
+        bpf.write(positions)
+        bdf.write(term + ' ' + str(posting_seek_ptr) + ' ' + str(len(postings)) + ' ' + str(df) + ' '
+                  + str(last_doc_id) + ' ' + str(max_wt) + ' ' + str(len(positions)) + '\n')
+        posting_seek_ptr += len(postings) + len(positions)
+
+    bpf.close()
+    bdf.close()
+
+
+def remove_runs(block_ids):
+    # Block files already merged into an intermediate run
+    for block_id in block_ids:
+        os.remove(os.path.join(TMP_DICT_DIR, str(block_id) + FILE_EXT))
+        os.remove(os.path.join(TMP_POST_DIR, str(block_id) + FILE_EXT))
+
+
+def in_doc_id_order(parts, superseded_doc_ids):
+    # Whether the blocks' postings of a term can simply be concatenated: each block's doc_ids
+    # all come after the previous block's, and none of them may be a superseded version
+    prev_last_doc_id = None
+    for _, term_dict, block_posting, _ in parts:
+        first_doc_id, _ = binary_index.read_vb(block_posting, 0) # A gap from 0, or absolute with postings format 1
+        last_doc_id = int(term_dict[4])
+        if prev_last_doc_id is not None and first_doc_id <= prev_last_doc_id: return False
+        if bisect.bisect_left(superseded_doc_ids, first_doc_id) < bisect.bisect_right(superseded_doc_ids, last_doc_id): return False
+        prev_last_doc_id = last_doc_id
+    return True
+
+
+def concat_run_postings(parts):
+    # The blocks' postings of a term, which are in doc_id order, as one list:
+    # (postings, positions, df, last_doc_id, max_wt)
+    postings = bytearray()
+    positions = bytearray()
+    df = 0
+    last_doc_id = 0
+    max_wt = 0.0
+    for _, term_dict, block_posting, block_positions in parts:
+        if config.POSTINGS_FORMAT != 1:
+            # The first doc_id of every block is stored as a gap from 0,
+            # so re-base it onto the last doc_id of the previous block
+            block_posting = rebase_first_gap(block_posting, last_doc_id)
+        postings += block_posting
+        positions += block_positions
+        df += int(term_dict[3])
+        last_doc_id = int(term_dict[4])
+        max_wt = max(max_wt, float(term_dict[5]))
+    return postings, positions, df, last_doc_id, max_wt
+
+
+def decode_run_documents(block_posting, block_positions):
+    # The documents of a term's postings in a block file, as (doc_id, (tf, [pos_idx])),
+    # the form encode_term_postings takes
+    postings_decoded = vb.decode(block_posting)
+    documents = []
+    doc_id = 0
+    ptr = 0
+
+    if config.POSTINGS_FORMAT >= 3:
+        position_gaps = vb.decode(block_positions)
+        for i in range(0, len(postings_decoded), 2):
+            doc_id += postings_decoded[i]
+            tf = postings_decoded[i + 1]
+            documents.append((doc_id, (tf, list(itt.accumulate(position_gaps[ptr:ptr + tf])))))
+            ptr += tf
+        return documents
+
+    while ptr < len(postings_decoded):
+        tf = postings_decoded[ptr + 1]
+        position_indices = postings_decoded[ptr + 2:ptr + 2 + tf]
+        if config.POSTINGS_FORMAT == 1:
+            doc_id = postings_decoded[ptr]
+        else:
+            doc_id += postings_decoded[ptr]
+            position_indices = list(itt.accumulate(position_indices))
+        documents.append((doc_id, (tf, position_indices)))
+        ptr += 2 + tf
+    return documents
+
+
+def encode_skips(postings, positions):
+    # Skip stream of a merged format 4 posting list. For every block of config.SKIP_BLOCK_SIZE
+    # postings it holds three numbers: the gap from the last doc_id of the previous block to
+    # its own last doc_id, and the number of bytes the block takes in the doc_id and tf stream
+    # and in the positions stream. Lists that fit in a single block get no skip stream.
+    postings_decoded = vb.decode(postings)
+    df = len(postings_decoded) // 2
+    if df <= config.SKIP_BLOCK_SIZE: return b''
+
+    doc_ids = list(itt.accumulate(postings_decoded[0::2]))
+    tfs = postings_decoded[1::2]
+    posting_ends = vb.number_ends(postings)[1::2] # Just past the tf of every posting
+    position_ends = vb.number_ends(positions)
+
+    skips = bytearray()
+    prev_doc_id = prev_end = prev_pos_end = num_positions = 0
+    for start in range(0, df, config.SKIP_BLOCK_SIZE):
+        end = min(start + config.SKIP_BLOCK_SIZE, df)
+        num_positions += sum(tfs[start:end])
+        pos_end = position_ends[num_positions - 1]
+
+        vb.encode_into(skips, doc_ids[end - 1] - prev_doc_id)
+        vb.encode_into(skips, posting_ends[end - 1] - prev_end)
+        vb.encode_into(skips, pos_end - prev_pos_end)
+        prev_doc_id, prev_end, prev_pos_end = doc_ids[end - 1], posting_ends[end - 1], pos_end
+    return bytes(skips)
+
+
+def push_next_block_term(heap, block_idx, bdf):
+    line = bdf.readline()
+    if line:
+        term_dict = line.split()
+        heapq.heappush(heap, (term_dict[0], block_idx, term_dict))
+
+
+def rebase_first_gap(block_posting, prev_doc_id):
+    # prev_doc_id must be below the first doc_id of block_posting, see in_doc_id_order
+    first_doc_id, first_len = binary_index.read_vb(block_posting, 0)
+    return vb.encode_number(first_doc_id - prev_doc_id) + block_posting[first_len:]
 
 
 def flush_temp_dirs():
+    if not os.path.exists(TMP_DIR): return # Already flushed
+
     for f in os.listdir(TMP_DICT_DIR): os.remove(os.path.join(TMP_DICT_DIR, f))
     os.rmdir(TMP_DICT_DIR)
     for f in os.listdir(TMP_POST_DIR): os.remove(os.path.join(TMP_POST_DIR, f))
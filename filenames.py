@@ -2,5 +2,9 @@
 dict_file = ''
 postings_file = ''
 lengths_file = 'lengths.txt'
+lengths_bin_file = 'lengths.bin'
+deleted_file = 'deleted.txt'
+dead_df_file = 'deleted_df.txt'
+generation_file = 'generation.txt'
 query_file = ''
 results_file = ''
@@ -1,13 +1,15 @@
 #!/usr/bin/python3
 
+import collections
 import csv
 import getopt
-import itertools as itt
 import multiprocessing as mp
+import resource
 import sys
 import time
 
 import config
+import filenames
 import file_operations
 import language_operations
 
@@ -15,22 +17,270 @@ csv.field_size_limit(100000000)
 
 
 def usage():
-    print("usage: " + sys.argv[0] + " -i dataset-file -d dictionary-file -p postings-file")
+    print("usage: " + sys.argv[0] + " -i dataset-file -d dictionary-file -p postings-file [-b] [-w workers] [-a | -u]")
+    print("       " + sys.argv[0] + " -x doc-id[,doc-id...] -d dictionary-file -p postings-file")
+    print("       " + sys.argv[0] + " -c -d dictionary-file -p postings-file")
+    print("  -b  write a binary, memory-mappable dictionary (and lengths.bin) instead of text")
+    print("  -w  number of worker processes (default: config.NUM_WORKER_PROCESSES)")
+    print("  -a  append the documents not indexed yet to the existing index, as a new delta segment")
+    print("  -u  like -a, but every document is indexed, replacing the indexed version of those already there")
+    print("  -x  delete documents from the existing index")
+    print("  -c  compact the existing index, merging its delta segments into the main one")
 
 
-def process_block(doc_id_map, mini_block):
-    for row in mini_block:
-        doc_id = int(row["document_id"])
-        content = row["title"] + row["court"] + row["content"]
+def read_documents(csvdata):
+    # Streams (doc_id, content) pairs from the CSV rows, keeping only the indexed text
+    # Columns: 'document_id', 'title', 'content', 'date_posted', 'court'
+    for row in csvdata:
+        yield int(row["document_id"]), row["title"] + row["court"] + row["content"]
+
+
+def estimate_postings_bytes(num_tokens):
+    # Estimated memory taken by the postings of num_tokens tokens while a block is inverted
+    return num_tokens * config.POSTINGS_BYTES_PER_TOKEN
+
+
+def split_mini_blocks(documents, max_bytes, max_docs=None):
+    # Groups the (doc_id, content) stream into mini blocks whose estimated postings stay
+    # within max_bytes, and of at most max_docs documents. Tokens are counted in the raw
+    # content as runs of letters, like process_document splits them, whatever separates them;
+    # a document over the budget gets a mini block of its own.
+    mini_block = []
+    mini_block_bytes = 0
+    for doc_id, content in documents:
+        doc_bytes = estimate_postings_bytes(language_operations.count_tokens(content))
+        if mini_block and (mini_block_bytes + doc_bytes > max_bytes or (max_docs is not None and len(mini_block) >= max_docs)):
+            yield mini_block
+            mini_block = []
+            mini_block_bytes = 0
+        mini_block.append((doc_id, content))
+        mini_block_bytes += doc_bytes
+    if mini_block: yield mini_block
 
+
+def process_block(mini_block):
+    # Returns the condensed form of every (doc_id, content) document in mini_block as a list of
+    # (doc_id, doc_terms) tuples, which is sent back to the parent in one piece
+    processed = []
+    for doc_id, content in mini_block:
         print('Processing document', doc_id)
-        
-        doc_id_map[doc_id] = language_operations.process_document(doc_id, content)
+
+        processed.append((doc_id, language_operations.process_document(doc_id, content)))
+    return processed
+
+
+def invert_block(run_id, mini_block):
+    # Condenses and inverts mini_block inside the worker, then writes it out as its own
+    # SPIMI run. Only the run's id, doc lengths and size statistics go back to the parent.
+    doc_id_map = dict(process_block(mini_block))
+    run_lengths_map = {}
+
+    if not doc_id_map: return None, run_lengths_map, None
+
+    block_stats = file_operations.write_block(run_id, doc_id_map, run_lengths_map)
+    return run_id, run_lengths_map, block_stats
+
+
+def build_index(in_data, out_dict, out_postings, binary=False, num_workers=config.NUM_WORKER_PROCESSES, append=False, update=False):
+    # Returns the number of documents indexed
+    # append: only the documents missing from the existing index are indexed, into a new
+    # delta segment of it; binary is then taken from the existing index
+    # update: like append, but every document is indexed, and the versions of those already
+    # in the index are deleted
+    append = append or update
+    if append:
+        indexed_lengths_map, binary, segment = file_operations.init_append(out_dict, out_postings)
+    else:
+        # A full build writes generation 0 of the index. Its old files are removed rather than
+        # overwritten, so searchers that have them open keep reading them, and delta segments
+        # or tombstones left from the index being replaced are not applied to the new one.
+        file_operations.init_indexing(out_dict, out_postings, binary)
+        file_operations.remove_generation(0)
+        indexed_lengths_map = {}
+
+    block_ids = []       # Contains the written block_ids, in CSV order for merging
+    lengths_map = {}     # Contains doc_id - doc_length mappings
+    superseded = {}      # Contains doc_id - block_id mappings of the documents found in more than one block,
+                         # to the block with their last version
+
+    block_id = 0         # ID of current block
+    doc_id_map = {}      # Condensed documents not yet written, when the parent inverts
+    doc_id_map_tokens = 0
+    block_stats = []     # (num_docs, num_tokens, num_terms, bytes_written) of every block
+
+    csvfile = open(in_data, 'r', encoding='utf-8')
+    csvdata = csv.DictReader(csvfile, delimiter=',', quotechar='"')
+
+    # The CSV file is streamed in mini blocks, one per worker task. When the workers invert,
+    # every mini block is a SPIMI block of its own: up to config.SPIMI_MEMORY_BUDGET of
+    # estimated postings (and SPIMI_BLOCK_SIZE documents, if set), however long the
+    # documents, so the workers together hold up to num_workers times the budget. When the
+    # parent inverts, a mini block is a worker's share of the parent's block.
+    max_bytes = config.SPIMI_MEMORY_BUDGET
+    max_docs = config.SPIMI_BLOCK_SIZE
+    if not config.WORKER_INVERSION:
+        max_bytes //= num_workers
+        max_docs = max(1, max_docs // num_workers) if max_docs else None
+    documents = read_documents(csvdata)
+    if append and not update: documents = ((doc_id, content) for doc_id, content in documents if doc_id not in indexed_lengths_map)
+    mini_blocks = split_mini_blocks(documents, max_bytes, max_docs)
+
+    def collect(result):
+        # Wait for a worker to finish a mini block, in CSV order
+        if config.WORKER_INVERSION:
+            # Every worker has already written its own run; record them in run order
+            # so that later versions of a document replace earlier ones
+            run_id, run_lengths_map, run_stats = result.get()
+            if run_id is not None:
+                block_ids.append(run_id)
+                block_stats.append(run_stats)
+            for doc_id in run_lengths_map:
+                if doc_id in lengths_map: superseded[doc_id] = run_id
+            lengths_map.update(run_lengths_map)
+            return
+
+        # The parent inverts blocks of up to the whole memory budget, counted exactly
+        nonlocal doc_id_map_tokens
+        for doc_id, doc_terms in result.get():
+            doc_id_map[doc_id] = doc_terms
+            doc_id_map_tokens += sum(tf for tf, _ in doc_terms[0].values())
+            if (estimate_postings_bytes(doc_id_map_tokens) >= config.SPIMI_MEMORY_BUDGET
+                    or (config.SPIMI_BLOCK_SIZE and len(doc_id_map) >= config.SPIMI_BLOCK_SIZE)):
+                write_pending_block()
+
+    def write_pending_block():
+        nonlocal block_id, doc_id_map, doc_id_map_tokens
+        block_id += 1
+        for doc_id in doc_id_map:
+            if doc_id in lengths_map: superseded[doc_id] = block_id
+        block_stats.append(file_operations.write_block(block_id, doc_id_map, lengths_map))
+        block_ids.append(block_id)
+        doc_id_map = {}
+        doc_id_map_tokens = 0
+
+    # One pool lives for the whole run, fed by a bounded pipeline: the parent parses the
+    # CSV file while the workers tokenize, but once config.INGEST_QUEUE_DEPTH mini blocks
+    # per worker are waiting or in progress, it stops reading until the oldest is done.
+    # Memory is therefore bounded by the queue depth, not by the size of the file.
+    max_in_flight = config.INGEST_QUEUE_DEPTH * num_workers
+    with mp.Pool(num_workers) as pool:
+        in_flight = collections.deque() # AsyncResults of the mini blocks sent out, in CSV order
+
+        for run_id, mini_block in enumerate(mini_blocks, 1):
+            if len(in_flight) >= max_in_flight: collect(in_flight.popleft())
+
+            if config.WORKER_INVERSION:
+                # One run per mini block, numbered in CSV order
+                in_flight.append(pool.apply_async(invert_block, (run_id, mini_block)))
+            else:
+                in_flight.append(pool.apply_async(process_block, (mini_block,)))
+
+        while in_flight: collect(in_flight.popleft())
+        if doc_id_map: write_pending_block()
+
+    csvfile.close()
+
+    if block_stats:
+        largest = max(block_stats, key=lambda stats: stats[1])
+        print('Blocks written: ' + str(len(block_stats)) + ', largest ' + str(largest[0]) + ' documents, '
+              + str(largest[1]) + ' tokens, ~' + str(round(estimate_postings_bytes(largest[1]) / 2**20, 1)) + ' MB of postings in memory')
+
+    if superseded:
+        # A later row of the CSV file replaces an earlier one with the same document_id
+        print(len(superseded), 'documents found more than once, keeping their last version')
+
+    if append and not lengths_map:
+        print('No new documents to index')
+    elif append:
+        # The delta's postings go after the existing ones, and the lengths file and N cover both
+        print('Writing delta segment', filenames.dict_file)
+        file_operations.merge_blocks(block_ids, {**indexed_lengths_map, **lengths_map}, binary, append=True, superseded=superseded)
+        if update:
+            # Only once the new versions are written, their old ones are deleted
+            updated = [doc_id for doc_id in lengths_map if doc_id in indexed_lengths_map]
+            filenames.dict_file = out_dict
+            file_operations.add_tombstones(updated, segment)
+            print('Updated', len(updated), 'documents')
+    else:
+        # MERGE THE BLOCKS
+        file_operations.merge_blocks(block_ids, lengths_map, binary, superseded=superseded)
+        file_operations.publish_generation(0)
+
+    # REMOVE TMP FOLDER
+    file_operations.flush_temp_dirs()
+
+    return len(lengths_map)
+
+
+def delete_documents(out_dict, out_postings, doc_ids):
+    # Records a tombstone for each document: its postings are left where they are and
+    # filtered out by search until the index is compacted. Deleted documents stay in the
+    # lengths file until then too, but search leaves them out of N and of every df.
+    # Returns the number of documents deleted
+    file_operations.init_update(out_dict, out_postings)
+    lengths_map = file_operations.load_lengths_map()
+
+    unknown = [doc_id for doc_id in doc_ids if doc_id not in lengths_map]
+    if unknown: print('Not in the index:', ' '.join(str(doc_id) for doc_id in unknown))
+
+    deleted = [doc_id for doc_id in doc_ids if doc_id in lengths_map]
+    file_operations.add_tombstones(deleted, file_operations.DELETED)
+
+    # REMOVE TMP FOLDER
+    file_operations.flush_temp_dirs()
+
+    return len(deleted)
+
+
+def compact_index(out_dict, out_postings):
+    # Merges the delta segments of the index into its main segment, without the deleted
+    # postings: all segments are written out as one SPIMI run, and merged like the runs of a
+    # full build. The compacted index is written as the next generation of the index, and
+    # published in one step once complete (see file_operations.publish_generation): searchers
+    # started before then load every file of the old generation, those started after every
+    # file of the new one, and searchers that already have the index open keep their files.
+    # Returns the number of documents in the index.
+    binary = file_operations.init_update(out_dict, out_postings)
+    delta_files = file_operations.delta_dict_files()
+    dictionary = file_operations.load_dictionary()
+    lengths_map = file_operations.load_lengths_map()
+    if not delta_files and file_operations.tombstones is None:
+        print('No delta segments or deleted documents to compact')
+        if hasattr(dictionary, 'close'): dictionary.close() # A text dictionary is a plain dict
+        file_operations.flush_temp_dirs()
+        return len(lengths_map)
+
+    lengths_map = {doc_id: length for doc_id, length in lengths_map.items() if not file_operations.is_deleted(doc_id)}
+
+    file_operations.write_segments_run(1, dictionary, lengths_map)
+    dictionary.close()
+    file_operations.close_postings_reader()
+
+    # Files left by a compaction that was interrupted are written over
+    compacted_gen = file_operations.generation + 1
+    file_operations.init_indexing(out_dict, out_postings, binary, compacted_gen)
+    file_operations.remove_generation(compacted_gen)
+    file_operations.merge_blocks([1], lengths_map, binary)
+    file_operations.flush_temp_dirs()
+
+    file_operations.publish_generation(compacted_gen)
+    print('Compacted', len(delta_files), 'delta segments into generation', compacted_gen)
+    return len(lengths_map)
+
+
+def peak_rss():
+    # Peak resident set size in MB of this process and of its largest finished child
+    scale = 1024 if sys.platform != 'darwin' else 1024 * 1024 # ru_maxrss is in KB on Linux, bytes on macOS
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale)
 
 
 if __name__ == '__main__':
     # ===================================================
     in_data = out_dict = out_postings = None
+    binary = append = update = compact = False
+    deleted_doc_ids = None
+    num_workers = config.NUM_WORKER_PROCESSES
     # ===================================================
     # DEBUG
     # in_data = '../dataset/dataset.csv'
@@ -40,7 +290,7 @@ if __name__ == '__main__':
     # ===================================================
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'i:d:p:')
+        opts, args = getopt.getopt(sys.argv[1:], 'i:d:p:bw:aux:c')
     except getopt.GetoptError:
         usage()
         sys.exit(2)
@@ -52,10 +302,23 @@ if __name__ == '__main__':
             out_dict = a
         elif o == '-p':
             out_postings = a
+        elif o == '-b':
+            binary = True
+        elif o == '-w':
+            num_workers = int(a)
+        elif o == '-a':
+            append = True
+        elif o == '-u':
+            update = True
+        elif o == '-x':
+            deleted_doc_ids = [int(doc_id) for doc_id in a.split(',')]
+        elif o == '-c':
+            compact = True
         else:
             assert False, "unhandled option"
 
-    if in_data is None or out_postings is None or out_dict is None:
+    if (out_postings is None or out_dict is None or (in_data is None) != (compact or deleted_doc_ids is not None)
+            or compact + append + update + (deleted_doc_ids is not None) > 1):
         usage()
         sys.exit(2)
 
@@ -70,53 +333,19 @@ if __name__ == '__main__':
     # ===========================================================================
 
     indexing_start_time = time.perf_counter()
-    file_operations.init_indexing(out_dict, out_postings)
-
-    block_map = {}       # Contains term - block_id mappings for merging
-    lengths_map = {}     # Contains doc_id - doc_length mappings
 
-    block_id = 0         # ID of current block
-
-    csvfile = open(in_data, 'r', encoding='utf-8')
-    csvdata = csv.DictReader(csvfile, delimiter=',', quotechar='"')
-    # Columns: 'document_id', 'title', 'content', 'date_posted', 'court'
-
-    # Split iterator into blocks
-    split_every = (lambda n, it: itt.takewhile(bool, (list(itt.islice(it, n)) for _ in itt.repeat(None))))
-    blocks_iter = split_every(config.SPIMI_BLOCK_SIZE, csvdata)
-
-    for block_iter in blocks_iter:
-        block_iter_len = len(block_iter)
-        
-        # Each worker will take one of the mini blocks to process
-        mini_blocks = [ block_iter[
-                i * block_iter_len // config.NUM_WORKER_PROCESSES : (i + 1) * block_iter_len // config.NUM_WORKER_PROCESSES] 
-                for i in range(config.NUM_WORKER_PROCESSES) ]
-        
-        with mp.Manager() as manager:
-            doc_id_map = manager.dict() # The initial dictionary housing documents in its condensed form
-            
-            jobs = []
-            for i in range(config.NUM_WORKER_PROCESSES):
-                p = mp.Process(target=process_block, args=(doc_id_map, mini_blocks[i]))
-                jobs.append(p)
-
-            for p in jobs: p.start()
-            for p in jobs: p.join()
-            
-            # Write block to file
-            block_id += 1
-            file_operations.write_block(block_id, doc_id_map, block_map, lengths_map)
-
-    csvfile.close()
-
-    # MERGE THE BLOCKS
-    file_operations.merge_blocks(block_map, lengths_map)
-
-    # REMOVE TMP FOLDER
-    file_operations.flush_temp_dirs()
+    if compact:
+        num_docs = compact_index(out_dict, out_postings)
+    elif deleted_doc_ids is not None:
+        num_docs = delete_documents(out_dict, out_postings, deleted_doc_ids)
+    else:
+        num_docs = build_index(in_data, out_dict, out_postings, binary, num_workers, append, update)
 
     print('===================================')
     indexing_end_time = time.perf_counter()
     indexing_time_elapsed = indexing_end_time - indexing_start_time
+    print('Documents: ' + str(num_docs))
     print('Time Elapsed: ' + str(indexing_time_elapsed) + 's')
+    print('Throughput: ' + str(num_docs / indexing_time_elapsed) + ' documents/s')
+    parent_rss, worker_rss = peak_rss()
+    print('Peak RSS: ' + str(round(parent_rss, 1)) + ' MB (parent), ' + str(round(worker_rss, 1)) + ' MB (largest worker)')
@@ -1,13 +1,49 @@
+import functools
 import re
 
 from nltk.corpus import wordnet
 from nltk.stem import PorterStemmer
 from nltk.tokenize import sent_tokenize, word_tokenize
 
+import config
 import vsm
 
 stemmer = PorterStemmer()
 
+# Memoized stemmer shared by document and query processing; word frequencies are
+# Zipfian, so a bounded cache catches almost every token after the first few documents
+stem = functools.lru_cache(maxsize=config.STEM_CACHE_SIZE)(stemmer.stem)
+
+# Words that NLTK's word_tokenize splits in two even without punctuation,
+# mapped to the index of the split (see nltk's MacIntyreContractions)
+CONTRACTION_SPLITS = {'cannot': 3, 'gimme': 3, 'gonna': 3, 'gotta': 3, 'lemme': 3, 'wanna': 3}
+
+def fast_tokenize(stripped_content):
+    # Tokenizes text that has already been reduced to letters and spaces.
+    # Gives the same tokens as sent_tokenize + word_tokenize on such text: there is
+    # no punctuation left to end a sentence, so only whitespace and the
+    # contraction splits apply.
+    for token in stripped_content.split():
+        split_idx = CONTRACTION_SPLITS.get(token.lower())
+        if split_idx is None:
+            yield token
+        else:
+            yield token[:split_idx]
+            yield token[split_idx:]
+
+# Runs of letters, which become the tokens of process_document
+LETTER_RUN = re.compile('[a-zA-Z]+')
+
+def count_tokens(content):
+    # Number of tokens process_document finds in content, counted without stemming them
+    words = LETTER_RUN.findall(str(content))
+    return len(words) + sum(1 for word in words if word.lower() in CONTRACTION_SPLITS)
+
+def tokenize(stripped_content):
+    if config.FAST_TOKENIZER:
+        return fast_tokenize(stripped_content)
+    return (token for sentence in sent_tokenize(stripped_content) for token in word_tokenize(sentence))
+
 def process_document(doc_id, content):
     # Opens a file, processes the file and returns a tuple:
     # Element 0: dict -> K: term
@@ -17,21 +53,17 @@ def process_document(doc_id, content):
     stripped_content = re.sub('[^a-zA-Z]',   # Search for all non-letters
                               ' ',           # Replace all non-letters with space
                               str(content))
-                           
-    sentences = sent_tokenize(stripped_content)
 
     position_idx = 1
-    for sentence in sentences:
-        tokens = word_tokenize(sentence)
-        for token in tokens:
-            term = stemmer.stem(token.lower())
-            if term in doc_terms[0]:
-                doc_terms[0][term][0] += 1
-                doc_terms[0][term][1].append(position_idx)
-            else:
-                doc_terms[0][term] = [1, [position_idx]]
+    for token in tokenize(stripped_content):
+        term = stem(token.lower())
+        if term in doc_terms[0]:
+            doc_terms[0][term][0] += 1
+            doc_terms[0][term][1].append(position_idx)
+        else:
+            doc_terms[0][term] = [1, [position_idx]]
 
-            position_idx += 1
+        position_idx += 1
     
     doc_terms[1] = vsm.compute_length_squared([vsm.compute_log_term_freq(val[0]) for val in doc_terms[0].values()])
     return doc_terms
@@ -65,6 +97,10 @@ def get_term_postings(doc_id_map):
     
     return term_map
 
+# The last word of a phrase: the word, then the closing quote and an optional slop ("a b"~2)
+PHRASE_END = re.compile(r'(.*)"(?:~(\d+))?$')
+PHRASE_SLOP = re.compile(r'(?<=")~\d+')
+
 # Assume that the given input string is a boolean query.
 # Insert OR operators between two words if it is not part of a phrasal query,
 # Otherwise insert AND operator.
@@ -80,18 +116,23 @@ def parse_boolean_query(string):
     while ptr < len(line):
         if line[ptr][0] == '\"':
             phrase = ''
-            if line[ptr][-1] == '\"':
-                # If phrase only consists of one word, remove quotes
-                boolean_query.append(stemmer.stem(line[ptr][1:-1]))
+            if PHRASE_END.match(line[ptr][1:]):
+                # If phrase only consists of one word, remove quotes (and slop)
+                boolean_query.append(stem(PHRASE_END.match(line[ptr][1:]).group(1)))
             else:
-                phrase = stemmer.stem(line[ptr][1:])
+                phrase = stem(line[ptr][1:])
                 ptr += 1
                 # Append all terms in the phrase to a separate list until a matching '"' is found,
                 # then treat this list as a single token in the boolean query
-                while ptr < len(line) and line[ptr][-1] != '\"':
-                    phrase += (' AND ' + stemmer.stem(line[ptr]))
+                while ptr < len(line) and not PHRASE_END.match(line[ptr]):
+                    phrase += (' AND ' + stem(line[ptr]))
                     ptr += 1
-                phrase += (' AND ' + stemmer.stem(line[ptr][:-1]))
+                phrase_end = PHRASE_END.match(line[ptr]) if ptr < len(line) else None
+                if phrase_end:
+                    phrase += (' AND ' + stem(phrase_end.group(1)))
+                    if phrase_end.group(2):
+                        # A proximity query "a b"~k: the slop is kept as the last element
+                        phrase += (' ~' + phrase_end.group(2))
                 if boolean_query == [] or boolean_query[-1] == 'AND':
                     boolean_query.append(phrase.split())
                 else:
@@ -101,18 +142,18 @@ def parse_boolean_query(string):
             boolean_query.append(line[ptr])
         else:
             if boolean_query == [] or boolean_query[-1] == 'AND':
-                boolean_query.append(stemmer.stem(line[ptr]))
+                boolean_query.append(stem(line[ptr]))
             else:
                 boolean_query.append('OR')
-                boolean_query.append(stemmer.stem(line[ptr]))
+                boolean_query.append(stem(line[ptr]))
         ptr += 1
 
     return boolean_query
 
 
 def parse_free_query(string):
-    vsm_query = ' '.join(string.replace('AND', '').replace('\"', '').split())
-    return [stemmer.stem(term) for term in vsm_query.split()]
+    vsm_query = ' '.join(re.sub(PHRASE_SLOP, '', string).replace('AND', '').replace('\"', '').split())
+    return [stem(term) for term in vsm_query.split()]
 
 
 # # UNCOMMENT THE FOLLOWING IF DOING THESAURUS-BASED QUERY EXPANSION
@@ -157,16 +198,3 @@ def parse_query(string, dictionary):
     # print('vsm_query:', vsm_query)
 
     return(boolean_query, vsm_query)
-
-def calculate_doc_score(doc_id, doc_lengths, dictionary, query_wt, query_length_sqr, vsm_query):
-    print('Calculating score for document', doc_id)
-    doc_length_sqr = doc_lengths[doc_id]  # returns -> doc_length_sqr
-
-    term_scores = {term: vsm.get_term_score(dictionary, doc_id, term, doc_length_sqr, query_wt, query_length_sqr)
-                    for term in vsm_query}
-    # returns -> {<term> <score>}
-
-    # Accumulates the squared lnc-ltc score on a term basis - see general notes in README.txt 
-    this_score = (sum(term_scores[term] for term in term_scores)) ** 2 * float(doc_length_sqr) * float(query_length_sqr)
-
-    return (int(doc_id), this_score)
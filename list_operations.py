@@ -1,126 +1,156 @@
-import math
-
-def create_skip_ptrs(li):
-    skip_ptrs = []
-    skip_dist = math.floor(math.sqrt(len(li)))
-    
-    for s in range(0, len(li), skip_dist):
-        skip_ptrs.append(s)
-    return skip_ptrs
-
-
-def search(a_val, b_posting, b_ptr, b_skip_ptr, skip_ptrs):
-    found = False
-
-    if b_posting[b_ptr] <= a_val:
-        # Advance skip_ptr and b_ptr is less than value to find
-        while b_skip_ptr < len(skip_ptrs) and b_posting[skip_ptrs[b_skip_ptr]] < a_val:
-            b_ptr = skip_ptrs[b_skip_ptr]
-            b_skip_ptr += 1
-        
-        # If value at skip_ptr is the target value, output
-        if b_skip_ptr < len(skip_ptrs) and b_posting[skip_ptrs[b_skip_ptr]] == a_val:
-            found = True
-            b_ptr = skip_ptrs[b_skip_ptr]
-        else:
-            # Target value may exist between b_ptr and skip_ptr in b.
-            # Binary search to check if target value exists in b,
-            # then advance b_ptr to the end position of the binary
-            # search regardless of search result.
-
-            low = b_ptr
-            high = 0
-            if b_skip_ptr < len(skip_ptrs):
-                high = skip_ptrs[b_skip_ptr]
-            else:
-                high = len(b_posting) - 1
-            
-            mid = 0
-            while low <= high:
-                mid = math.floor((high + low) / 2)
-
-                if b_posting[mid] < a_val:
-                    low = mid + 1
-                elif b_posting[mid] > a_val:
-                    high = mid - 1
-                else:
-                    found = True
-                    break
-            b_ptr = mid
-    return b_ptr, b_skip_ptr, found
+import itertools as itt
+from bisect import bisect_left
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Set operations over sorted lists of distinct integers (doc_ids or positions).
+# Inputs are never modified. Lists of similar length are combined in linear time;
+# when one list is more than SKEW_RATIO times longer than the other, each element of
+# the short list is binary-searched in the rest of the long one instead, so the long
+# list is never walked element by element. If both inputs are NumPy arrays, the
+# operation is done with NumPy and returns an array.
+#
+# Unions merge with sorted(): Timsort finds the already sorted input lists as runs and
+# merges them pairwise in C, which is linear for two lists and O(n log k) for k lists,
+# and several times faster than a merge loop or heapq.merge in Python.
+
+SKEW_RATIO = 8
+
+
+def is_array(li):
+    return np is not None and isinstance(li, np.ndarray)
+
+
+def as_list(li):
+    return li.tolist() if is_array(li) else li
+
 
 # ====================================================================
 # SET OPERATION METHODS
 
 def intersect(x, y):
-    if not x or not y: return []
-    skip_ptrs = []
-    if len(x) < len(y):
+    if is_array(x) and is_array(y): return array_intersect(x, y)
+    if len(x) == 0 or len(y) == 0: return []
+    x, y = as_list(x), as_list(y)
+
+    if len(x) <= len(y):
         a = x
         b = y
-        skip_ptrs = create_skip_ptrs(y)
     else:
         a = y
         b = x
-        skip_ptrs = create_skip_ptrs(x)
-    
-    b_ptr = 0
-    b_skip_ptr = 0
 
-    result = []
+    if len(b) > SKEW_RATIO * len(a):
+        result = []
+        b_ptr = 0
+        for a_val in a:
+            b_ptr = bisect_left(b, a_val, b_ptr)
+            if b_ptr == len(b): break
+            if b[b_ptr] == a_val:
+                result.append(a_val)
+                b_ptr += 1
+        return result
 
-    for a_val in a:
-        b_ptr, b_skip_ptr, found = search(a_val, b, b_ptr, b_skip_ptr, skip_ptrs)
-        if found:
-            result.append(a_val)
+    b_set = set(b)
+    return [a_val for a_val in a if a_val in b_set]
 
-    return result
 
+def union(x, y):
+    if is_array(x) and is_array(y): return np.union1d(x, y)
+    x, y = as_list(x), as_list(y)
+    if not x: return list(y)
+    if not y: return list(x)
+
+    if len(x) <= len(y):
+        a = x
+        b = y
+    else:
+        a = y
+        b = x
 
-def union(a, b):
-    if not a: return b
-    if not b: return a
+    if len(b) <= SKEW_RATIO * len(a):
+        return list(dict.fromkeys(sorted(a + b))) # Sorted, so duplicates are adjacent
 
+    # Copy the runs of b between consecutive elements of a in one slice each
     result = []
-    while a and b:
-        if a[0] < b[0]:
-            result.append(a.pop(0))
-        elif a[0] > b[0]:
-            result.append(b.pop(0))
-        else:
-            result.append(a.pop(0))
-            b.pop(0)
-    
-    if a:
-        result += a
-    if b:
-        result += b
-
+    b_ptr = 0
+    for a_val in a:
+        b_end = bisect_left(b, a_val, b_ptr)
+        result += b[b_ptr:b_end]
+        result.append(a_val)
+        if b_end < len(b) and b[b_end] == a_val: b_end += 1
+        b_ptr = b_end
+    result += b[b_ptr:]
     return result
 
 
 def subtract(x, y):
+    # Elements of x that are not in y
+    if is_array(x) and is_array(y): return np.setdiff1d(x, y, assume_unique=True)
+    x, y = as_list(x), as_list(y)
     if not x: return []
-    if not y: return x
+    if not y: return list(x)
+
+    if len(y) > SKEW_RATIO * len(x):
+        result = []
+        y_ptr = 0
+        for x_val in x:
+            y_ptr = bisect_left(y, x_val, y_ptr)
+            if y_ptr == len(y) or y[y_ptr] != x_val: result.append(x_val)
+        return result
+
+    if len(x) > SKEW_RATIO * len(y):
+        # Copy the runs of x between consecutive elements of y in one slice each
+        result = []
+        x_ptr = 0
+        for y_val in y:
+            x_end = bisect_left(x, y_val, x_ptr)
+            result += x[x_ptr:x_end]
+            if x_end < len(x) and x[x_end] == y_val: x_end += 1
+            x_ptr = x_end
+        result += x[x_ptr:]
+        return result
+
+    y_set = set(y)
+    return [x_val for x_val in x if x_val not in y_set]
+
+
+def union_all(lists):
+    # n-ary union: a single k-way merge of all the lists, instead of
+    # len(lists) - 1 pairwise unions that copy the growing result each time
+    lists = [as_list(li) for li in lists if len(li) > 0]
+    if not lists: return []
+    if len(lists) == 1: return list(lists[0])
+    if len(lists) == 2: return union(lists[0], lists[1])
+
+    return list(dict.fromkeys(sorted(itt.chain.from_iterable(lists))))
+
+
+def intersect_all(lists):
+    # n-ary intersection, starting from the shortest list so the intermediate
+    # result only shrinks, and stopping as soon as it is empty
+    if not lists: return []
+    if len(lists) == 1: return list(as_list(lists[0]))
+
+    lists = sorted(lists, key=len)
+    result = intersect(lists[0], lists[1])
+    for li in lists[2:]:
+        if len(result) == 0: return []
+        result = intersect(result, li)
+    return result
 
-    x_posting_len = x[0]
-    y_posting_len = y[0]
-    
-    a_posting = x[1:x_posting_len + 1]
-    b_posting = y[1:y_posting_len + 1]
-    skip_ptrs = y[y_posting_len + 1:]
 
-    b_ptr = 0
-    b_skip_ptr = 0
-
-    a_ptr = 0
-    while a_ptr < len(a_posting):
-        b_ptr, b_skip_ptr, found = search(a_posting[a_ptr], b_posting, b_ptr, b_skip_ptr, skip_ptrs)
-        if found:
-            a_posting.remove(a_posting[a_ptr])
-        else:
-            a_ptr += 1
-    
-    result = a_posting
-    
-    return result
+# ====================================================================
+# NUMPY
+
+def array_intersect(a, b):
+    if len(a) > len(b): a, b = b, a
+    if len(a) == 0: return a
+
+    # Position of every element of the shorter array in the longer one
+    idx = np.searchsorted(b, a)
+    idx[idx == len(b)] = 0
+    return a[b[idx] == a]
@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+
+# Load generator for server.py.
+#
+# Opens a number of concurrent client connections, each sending queries one at a
+# time, and reports the latency distribution and throughput over all requests.
+
+import asyncio
+import getopt
+import itertools as itt
+import sys
+import time
+
+import file_operations
+import server
+
+
+def usage():
+    print("usage: " + sys.argv[0] + " (-u unix-socket-path | -t host:port) -b query-dir-or-jsonl [-c concurrency] [-n requests]")
+    print("  -n  number of requests, at least 1 (default: every query once per client)")
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, len(sorted_values) * p // 100)]
+
+
+async def client(unix_socket, tcp_address, queries, latencies):
+    if unix_socket is not None:
+        reader, writer = await asyncio.open_unix_connection(unix_socket)
+    else:
+        reader, writer = await asyncio.open_connection(tcp_address[0], tcp_address[1])
+
+    errors = 0
+    for query in queries:
+        start = time.perf_counter()
+        writer.write((query + '\n').encode('utf-8'))
+        await writer.drain()
+        response = await reader.readline()
+        latencies.append(time.perf_counter() - start)
+
+        if response.startswith(b'ERROR'): errors += 1
+
+    writer.close()
+    await writer.wait_closed()
+    return errors
+
+
+async def run(unix_socket, tcp_address, queries, concurrency, num_requests):
+    # Deal the requests out round-robin so every client sends a similar mix
+    requests = list(itt.islice(itt.cycle(queries), num_requests))
+    latencies = []
+
+    start = time.perf_counter()
+    errors = await asyncio.gather(*(client(unix_socket, tcp_address, requests[i::concurrency], latencies)
+                                    for i in range(concurrency)))
+    time_elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print('Requests: ' + str(len(latencies)) + ' (' + str(sum(errors)) + ' errors), concurrency: ' + str(concurrency))
+    if not latencies: return
+
+    print('Latency p50: ' + str(percentile(latencies, 50) * 1000) + 'ms')
+    print('Latency p99: ' + str(percentile(latencies, 99) * 1000) + 'ms')
+    print('Latency max: ' + str(latencies[-1] * 1000) + 'ms')
+    print('Throughput: ' + str(len(latencies) / time_elapsed) + ' queries/s')
+
+
+if __name__ == '__main__':
+    unix_socket = tcp_address = batch_file = None
+    concurrency = 8
+    num_requests = None
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'u:t:b:c:n:')
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-u':
+            unix_socket = a
+        elif o == '-t':
+            tcp_address = server.parse_tcp_address(a)
+        elif o == '-b':
+            batch_file = a
+        elif o == '-c':
+            concurrency = int(a)
+        elif o == '-n':
+            num_requests = int(a)
+        else:
+            assert False, "unhandled option"
+
+    if (batch_file is None or (unix_socket is None) == (tcp_address is None) or concurrency < 1
+            or (num_requests is not None and num_requests < 1)):
+        usage()
+        sys.exit(2)
+
+    try:
+        queries = [query for query_id, query, relevant_docs in file_operations.read_query_batch(batch_file)]
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    if not queries:
+        print('No queries found in', batch_file)
+        sys.exit(1)
+
+    if num_requests is None: num_requests = len(queries) * concurrency
+    concurrency = min(concurrency, num_requests)
+
+    asyncio.run(run(unix_socket, tcp_address, queries, concurrency, num_requests))
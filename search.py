@@ -2,32 +2,208 @@
 
 import getopt
 import multiprocessing as mp
+import os
 import sys
 import time
+from array import array
 
 import boolean_retrieval
 import config
 import filenames
 import file_operations
 import language_operations
-import list_operations
 import vsm
 
+index = None # (dictionary, N, doc_lengths), loaded once per process by load_index
+scoring_pool = None # Worker pool for parallel scoring, started by get_scoring_pool
 
-def worker(boolean_document_scores, input_files, boolean_result, doc_lengths, dictionary, query_wt, query_length_sqr, vsm_query):
-    # Reinitialize for this process
-    file_operations.init_search(input_files[0], input_files[1], input_files[3], input_files[4])
-
-    for doc_id in boolean_result:
-        boolean_document_scores.append(language_operations.calculate_doc_score(doc_id, doc_lengths, dictionary, query_wt, query_length_sqr, vsm_query))
 
 def usage():
-    print("usage: " + sys.argv[0] + " -d dictionary-file -p postings-file -q query-file -o output-file-of-results")
+    print("usage: " + sys.argv[0] + " -d dictionary-file -p postings-file -q query-file -o output-file-of-results [-k top-k] [-e threshold] [--explain]")
+    print("       " + sys.argv[0] + " -d dictionary-file -p postings-file -b query-dir-or-jsonl -o output-dir-of-results [-k top-k] [-e threshold] [--explain]")
+    print("  -k         only rank the best k >= 1 boolean results (default: config.TOP_K, all if unset)")
+    print("  -e         drop boolean query terms found in at least this fraction of the documents (default: config.ELIMINATION_THRESHOLD)")
+    print("  --explain  print the boolean query plan with estimated and actual list sizes")
+
+
+def run_query(query, relevant_docs, dictionary, N, doc_lengths, top_k=None):
+    # Parse the query into a boolean query version and a free search version with query expansion
+    # Then process boolean query to retrieve list of documents to perform VSM
+    # Then use this list to compute VSM scores
+    # Every posting list is decoded at most once for all of these steps
+    file_operations.start_query()
+    boolean_query, vsm_query = language_operations.parse_query(query, dictionary)
+    if file_operations.tombstones is not None:
+        relevant_docs = [doc_id for doc_id in relevant_docs if not file_operations.is_deleted(doc_id)]
+
+    # Prepare boolean query for evaluation
+    rpn = boolean_retrieval.create_rpn(boolean_query)
+    plan = boolean_retrieval.create_plan(rpn, dictionary, N)
+
+    # Evaluate boolean query
+    boolean_result = boolean_retrieval.eval_plan(plan, dictionary, N)
+    boolean_result.sort()
+
+    if config.EXPLAIN_QUERIES:
+        print('Query plan:')
+        print('\n'.join(boolean_retrieval.explain_plan(plan)))
+
+    # ======================================================================
+
+    # Create the query document
+    query_wt, query_length_sqr = vsm.create_query_vector(vsm_query, dictionary, N)
+
+    print('Calculating scores...')
+    print('===================================')
+
+    if top_k is None: top_k = config.TOP_K
+    if top_k is not None:
+        # Only the best top_k boolean results are ranked, with early termination
+        relevant_document_scores = []
+        if relevant_docs:
+            relevant_score_map = vsm.accumulate_scores(set(relevant_docs), dictionary, doc_lengths, query_wt, query_length_sqr, vsm_query)
+            relevant_document_scores = [(int(doc_id), relevant_score_map[doc_id]) for doc_id in relevant_docs]
+
+        boolean_document_sorted_scores = vsm.top_k_scores(set(boolean_result), dictionary, doc_lengths, query_wt,
+                                                          query_length_sqr, vsm_query, top_k)
+        return relevant_document_scores + [(int(doc_id), score) for doc_id, score in boolean_document_sorted_scores]
+
+    # Score the boolean result and the given relevant documents in a single
+    # term-at-a-time pass over the query's posting lists
+    document_score_map = score_documents(set(boolean_result).union(relevant_docs),
+                                         dictionary, doc_lengths, query_wt, query_length_sqr, vsm_query)
+
+    relevant_document_scores = [(int(doc_id), document_score_map[doc_id]) for doc_id in relevant_docs]
+    boolean_document_scores = [(int(doc_id), document_score_map[doc_id]) for doc_id in boolean_result]
+
+    boolean_document_sorted_scores = sorted(boolean_document_scores, key=lambda x: (-x[1], x[0]))
+    return relevant_document_scores + boolean_document_sorted_scores
+
+
+def score_documents(doc_ids, dictionary, doc_lengths, query_wt, query_length_sqr, vsm_query):
+    # vsm.accumulate_scores, split over config.SCORING_PROCESSES workers when there are
+    # enough documents to make up for the cost of sending the work out
+    if (config.SCORING_PROCESSES <= 1 or len(doc_ids) < config.PARALLEL_SCORING_MIN_DOCS
+            or mp.current_process().daemon): # Pool workers cannot start pools of their own
+        return vsm.accumulate_scores(doc_ids, dictionary, doc_lengths, query_wt, query_length_sqr, vsm_query)
+
+    # Contiguous doc_id shards, so each worker only reads its range of every posting list
+    doc_ids = sorted(doc_ids)
+    shard_size = -(-len(doc_ids) // config.SCORING_PROCESSES)
+    jobs = [(array('q', doc_ids[i:i + shard_size]), query_wt, query_length_sqr, vsm_query)
+            for i in range(0, len(doc_ids), shard_size)]
+
+    scores = []
+    for shard_scores in get_scoring_pool().map(scoring_worker, jobs):
+        scores += shard_scores
+    return dict(zip(doc_ids, scores))
+
+
+def scoring_worker(job):
+    # Scores one shard against the index inherited from the parent (or loaded by init_batch_worker).
+    # The shard's doc_ids come in, and its scores go back, as flat arrays.
+    doc_ids, query_wt, query_length_sqr, vsm_query = job
+    dictionary, N, doc_lengths = index
+
+    file_operations.start_query()
+    return array('d', vsm.accumulate_shard(doc_ids.tolist(), dictionary, doc_lengths, query_wt, query_length_sqr, vsm_query))
+
+
+def get_scoring_pool():
+    # Started on first use, after the index is loaded, so forked workers share its
+    # memory-mapped files and dictionary pages instead of receiving copies
+    global scoring_pool
+    if scoring_pool is None:
+        scoring_pool = mp.Pool(config.SCORING_PROCESSES, initializer=init_batch_worker,
+                               initargs=(filenames.dict_file, filenames.postings_file, query_settings(), file_operations.generation))
+    return scoring_pool
+
+
+def close_scoring_pool():
+    global scoring_pool
+    if scoring_pool is not None:
+        scoring_pool.close()
+        scoring_pool.join()
+        scoring_pool = None
+
+
+def load_index():
+    global index
+    dictionary = file_operations.load_dictionary()
+    N, doc_lengths = file_operations.load_doc_lengths()
+
+    # Map the postings file once; boolean, phrase and VSM evaluation all read through it
+    file_operations.get_postings_reader()
+    index = (dictionary, N, doc_lengths)
+
+
+# ========================================================================
+# BATCH MODE
+
+def query_settings():
+    # The config values that command line options override, to hand to worker processes:
+    # only forked workers inherit the parent's config, spawned ones import it afresh
+    return {name: getattr(config, name) for name in ('TOP_K', 'ELIMINATION_THRESHOLD', 'EXPLAIN_QUERIES')}
+
+
+def init_batch_worker(dict_file, postings_file, settings=None, gen=None):
+    # settings: the parent's query_settings(); gen: the generation of the index it loaded
+    # Forked workers inherit the index loaded by the parent;
+    # workers started any other way load it themselves.
+    for name, value in (settings or {}).items(): setattr(config, name, value)
+
+    if index is None:
+        file_operations.init_search(dict_file, postings_file, None, None, gen)
+        load_index()
+
+
+def batch_worker(job):
+    query_id, query, relevant_docs, results_file = job
+    reader = file_operations.get_postings_reader()
+
+    start = time.perf_counter()
+    bytes_read = reader.bytes_read
+    document_scores = run_query(query, relevant_docs, *index)
+    file_operations.write_results(document_scores, results_file)
+
+    cache = file_operations.postings_cache
+    cache_stats = (cache.hits, cache.misses) if cache is not None else (0, 0)
+    return (query_id, len(document_scores), time.perf_counter() - start, reader.bytes_read - bytes_read) + cache_stats
+
+
+def run_batch(queries, results_dir):
+    # Runs every query of file_operations.read_query_batch against the index already
+    # loaded in this process, on a persistent worker pool.
+    if not os.path.exists(results_dir): os.mkdir(results_dir)
+
+    jobs = [(query_id, query, relevant_docs, os.path.join(results_dir, query_id + file_operations.FILE_EXT))
+            for query_id, query, relevant_docs in queries]
+
+    latencies = []
+    batch_start = time.perf_counter()
+
+    with mp.Pool(config.NUM_WORKER_PROCESSES, initializer=init_batch_worker,
+                 initargs=(filenames.dict_file, filenames.postings_file, query_settings(), file_operations.generation)) as pool:
+        for query_id, num_results, latency, bytes_read, cache_hits, cache_misses in pool.imap_unordered(batch_worker, jobs):
+            latencies.append(latency)
+            print('Query', query_id, 'retrieved', num_results, 'documents in', str(latency) + 's,', 'read', bytes_read, 'postings bytes,',
+                  'postings cache', cache_hits, 'hits', cache_misses, 'misses')
+
+    batch_time_elapsed = time.perf_counter() - batch_start
+
+    latencies.sort()
+    print('===================================')
+    print('Queries: ' + str(len(latencies)))
+    if latencies:
+        print('Latency mean: ' + str(sum(latencies) / len(latencies)) + 's')
+        print('Latency p50: ' + str(latencies[len(latencies) // 2]) + 's')
+        print('Latency p99: ' + str(latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)]) + 's')
+    print('Throughput: ' + str(len(latencies) / batch_time_elapsed if batch_time_elapsed else 0) + ' queries/s')
 
 
 if __name__ == '__main__':
     # ===================================================
-    dict_file = postings_file = queries_file = results_file = None
+    dict_file = postings_file = queries_file = results_file = batch_file = None
     # ===================================================
     # DEBUG
     # dict_file = 'dictionary.txt'
@@ -38,7 +214,7 @@ if __name__ == '__main__':
     # ===================================================
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'd:p:q:o:')
+        opts, args = getopt.getopt(sys.argv[1:], 'd:p:q:o:b:k:e:', ['explain'])
     except getopt.GetoptError:
         usage()
         sys.exit(2)
@@ -52,10 +228,19 @@ if __name__ == '__main__':
             queries_file = a
         elif o == '-o':
             results_file = a
+        elif o == '-b':
+            batch_file = a
+        elif o == '-k':
+            config.TOP_K = int(a) # Handed to batch and scoring workers by query_settings
+        elif o == '-e':
+            config.ELIMINATION_THRESHOLD = float(a)
+        elif o == '--explain':
+            config.EXPLAIN_QUERIES = True
         else:
             assert False, "unhandled option"
 
-    if dict_file is None or postings_file is None or queries_file is None or results_file is None:
+    if (dict_file is None or postings_file is None or results_file is None or (queries_file is None) == (batch_file is None)
+            or (config.TOP_K is not None and config.TOP_K < 1)):
         usage()
         sys.exit(2)
 
@@ -71,72 +256,41 @@ if __name__ == '__main__':
 
     start = time.perf_counter()
 
+    if batch_file is not None:
+        # Checked before the index is loaded
+        try:
+            queries = file_operations.read_query_batch(batch_file)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+
     file_operations.init_search(dict_file, postings_file, queries_file, results_file)
 
     # Load files
-    dictionary = file_operations.load_dictionary()
-    N, doc_lengths = file_operations.load_doc_lengths()
-    query, relevant_docs = file_operations.read_query_file()
-
-    # Parse the query into a boolean query version and a free search version with query expansion
-    # Then process boolean query to retrieve list of documents to perform VSM
-    # Then use this list to compute VSM scores
-    boolean_query, vsm_query = language_operations.parse_query(query, dictionary)
-
-    # Prepare boolean query for evaluation
-    rpn = boolean_retrieval.create_rpn(boolean_query)
-
-    # Evaluate boolean query
-    boolean_result = boolean_retrieval.eval_rpn(rpn, dictionary, N, vsm_query)
-    boolean_result.sort()
-    
-    # ======================================================================
-
-    # Create the query document
-    query_wt, query_length_sqr = vsm.create_query_vector(vsm_query, dictionary, N)
-    boolean_document_scores = []  # Document scores
-    relevant_document_scores = []
-
-    print('Calculating scores...')
-    print('===================================')
-
-    # Compute boolean scores with multiprocessing
-    boolean_result_len = len(boolean_result)
-    boolean_result_split = [ boolean_result[
-        i * boolean_result_len // config.NUM_WORKER_PROCESSES : (i + 1) * boolean_result_len // config.NUM_WORKER_PROCESSES]
-        for i in range(config.NUM_WORKER_PROCESSES) ]
+    load_index()
 
-    input_files = [filenames.dict_file, filenames.postings_file, filenames.lengths_file, filenames.query_file, filenames.results_file]
+    if batch_file is not None:
+        run_batch(queries, results_file)
+        document_scores = None
+    else:
+        query, relevant_docs = file_operations.read_query_file()
+        document_scores = run_query(query, relevant_docs, *index)
 
-    with mp.Manager() as manager:
-        boolean_document_scores = manager.list()
-        jobs = []
-        for i in range(config.NUM_WORKER_PROCESSES):
-            p = mp.Process(target=worker, args=(
-                boolean_document_scores, input_files, boolean_result_split[i], doc_lengths, dictionary, query_wt, query_length_sqr, vsm_query))
-            jobs.append(p)
-        
-        for p in jobs: p.start()
-        for p in jobs: p.join()
+    postings_bytes_read = file_operations.get_postings_reader().bytes_read
+    postings_cache = file_operations.postings_cache
+    close_scoring_pool()
+    file_operations.close_postings_reader()
 
-        # End multiprocessing.
-        # Now cleanup and sort scores
-
-        for doc_id in relevant_docs:
-            relevant_document_scores.append(
-                language_operations.calculate_doc_score(doc_id, doc_lengths, dictionary, query_wt, query_length_sqr, vsm_query))
-
-        boolean_document_sorted_scores = sorted(boolean_document_scores, key=lambda x: (-x[1], x[0]))
-        document_scores = relevant_document_scores + boolean_document_sorted_scores
-
-    # REMOVE TMP FOLDER
-    file_operations.flush_temp_dirs()
-
-    print('===================================')
-    print('Printing results to', results_file)
-    file_operations.write_results(document_scores)
+    if document_scores is not None:
+        print('===================================')
+        print('Printing results to', results_file)
+        file_operations.write_results(document_scores)
 
     print('===================================')
     time_elapsed = str(time.perf_counter() - start)
-    print('Retrieved: ' + str(len(document_scores)) + ' documents')
+    if document_scores is not None:
+        print('Retrieved: ' + str(len(document_scores)) + ' documents')
+        print('Postings read: ' + str(postings_bytes_read) + ' bytes')
+        if postings_cache is not None:
+            print('Postings cache: ' + str(postings_cache.hits) + ' hits, ' + str(postings_cache.misses) + ' misses')
     print('Time Elapsed: ' + str(time_elapsed) + 's')
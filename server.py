@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+
+# Long-running query server.
+#
+# The dictionary, lengths and postings mapping are loaded once and kept resident.
+# Clients connect over a Unix or TCP socket and send one query per line, in the
+# same syntax as the first line of a query file. Each query is answered with one
+# line of space-separated doc_ids, ranked as in search.py's results file, or a
+# line starting with 'ERROR' if the query could not be evaluated.
+#
+# Connections are served by an asyncio front-end, and queries are evaluated on a
+# pool of worker processes that inherit the loaded index.
+
+import asyncio
+import concurrent.futures
+import getopt
+import os
+import signal
+import sys
+
+import config
+import filenames
+import file_operations
+import search
+
+
+def usage():
+    print("usage: " + sys.argv[0] + " -d dictionary-file -p postings-file (-u unix-socket-path | -t host:port) [-w workers] [-k top-k]")
+    print("  -k  only rank the best k >= 1 boolean results (default: config.TOP_K, all if unset)")
+
+
+def init_server_worker(dict_file, postings_file, settings, gen):
+    # settings: the server's search.query_settings(), which only forked workers would inherit;
+    # gen: the generation of the index the server loaded
+    search.init_batch_worker(dict_file, postings_file, settings, gen)
+
+    # Query evaluation logs every step; keep it off the server's output
+    sys.stdout = open(os.devnull, 'w')
+
+
+def query_worker(query):
+    document_scores = search.run_query(query, [], *search.index)
+    return ' '.join(str(doc_id) for doc_id, score in document_scores)
+
+
+async def handle_client(reader, writer, executor):
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            line = await reader.readline()
+            if not line: break
+
+            query = line.decode('utf-8').strip()
+            if not query:
+                response = ''
+            else:
+                try:
+                    response = await loop.run_in_executor(executor, query_worker, query)
+                except Exception as e:
+                    response = 'ERROR ' + ' '.join(repr(e).split())
+
+            writer.write((response + '\n').encode('utf-8'))
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(unix_socket, tcp_address, executor):
+    client_handler = lambda reader, writer: handle_client(reader, writer, executor)
+
+    if unix_socket is not None:
+        if os.path.exists(unix_socket): os.remove(unix_socket)
+        server = await asyncio.start_unix_server(client_handler, path=unix_socket)
+        print('Serving on', unix_socket)
+    else:
+        server = await asyncio.start_server(client_handler, host=tcp_address[0], port=tcp_address[1])
+        print('Serving on', tcp_address[0] + ':' + str(tcp_address[1]))
+
+    # Serve until interrupted or terminated, then let the caller clean up
+    loop = asyncio.get_running_loop()
+    stop = loop.create_future()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, lambda: stop.done() or stop.set_result(None))
+
+    async with server:
+        await stop
+
+
+def parse_tcp_address(address):
+    host, port = address.rsplit(':', 1)
+    return (host or 'localhost', int(port))
+
+
+if __name__ == '__main__':
+    dict_file = postings_file = unix_socket = tcp_address = None
+    num_workers = config.NUM_WORKER_PROCESSES
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'd:p:u:t:w:k:')
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-d':
+            dict_file = a
+        elif o == '-p':
+            postings_file = a
+        elif o == '-u':
+            unix_socket = a
+        elif o == '-t':
+            tcp_address = parse_tcp_address(a)
+        elif o == '-w':
+            num_workers = int(a)
+        elif o == '-k':
+            config.TOP_K = int(a) # Handed to the query workers by search.query_settings
+        else:
+            assert False, "unhandled option"
+
+    if (dict_file is None or postings_file is None or (unix_socket is None) == (tcp_address is None)
+            or (config.TOP_K is not None and config.TOP_K < 1)):
+        usage()
+        sys.exit(2)
+
+    print('loading index...')
+    file_operations.init_search(dict_file, postings_file, None, None)
+    search.load_index()
+
+    executor = concurrent.futures.ProcessPoolExecutor(num_workers, initializer=init_server_worker,
+                                                      initargs=(filenames.dict_file, filenames.postings_file,
+                                                                search.query_settings(), file_operations.generation))
+    try:
+        asyncio.run(serve(unix_socket, tcp_address, executor))
+    finally:
+        executor.shutdown()
+        file_operations.close_postings_reader()
+        if unix_socket is not None and os.path.exists(unix_socket): os.remove(unix_socket)
@@ -1,7 +1,11 @@
+import heapq
 import math
 
+import config
 import file_operations
 
+TOP_K_MARGIN = 1e-9 # Relative slack on top-k score bounds, far above floating point rounding error
+
 def compute_log_term_freq(tf):
     return 1 + math.log(tf, 10) if tf != 0 else 0
 
@@ -14,6 +18,11 @@ def compute_length_squared(wt):
     return sum(weight**2 for weight in wt)
 
 
+def compute_doc_weight(tf, doc_length_sqr):
+    # Length-normalized lnc weight of a term in a document
+    return compute_log_term_freq(tf) / math.sqrt(doc_length_sqr) if doc_length_sqr != 0 else 0
+
+
 def compute_term_score(doc_wt, doc_length_sqr, query_wt, query_length_sqr):
     return ((doc_wt * query_wt) / (doc_length_sqr * query_length_sqr)) if (doc_length_sqr != 0 and query_length_sqr != 0) else 0
 
@@ -41,15 +50,145 @@ def create_query_vector(query_array, dictionary, N):
     return (query_wt, query_length)
 
 
-def get_term_score(dictionary, doc_id, term, doc_length_sqr, query_wt, query_length_sqr):
-    if term not in dictionary: return 0
-
-    term_posting = file_operations.retrieve_posting_list(term, dictionary)
-    if doc_id in term_posting:
-        doc_tf = len(term_posting[doc_id])
-        doc_wt = compute_log_term_freq(doc_tf)
-
-        # Calculates the interim score of a term - see general notes in README.txt 
-        return compute_term_score(float(doc_wt), float(doc_length_sqr), float(query_wt[term]), float(query_length_sqr))
-
-    else: return 0
+def accumulate_scores(doc_ids, dictionary, doc_lengths, query_wt, query_length_sqr, vsm_query):
+    # Term-at-a-time scoring: each query term's doc_ids and tfs are decoded once, and its
+    # interim score is added to the accumulator of every candidate document it contains.
+    # Terms are visited in query order, as the per-document scoring it replaced did,
+    # so the floating point sums (and therefore the rankings) are identical.
+    accumulator = {doc_id: 0 for doc_id in doc_ids}
+    # K: doc_id
+    # V: sum of interim term scores
+
+    sorted_doc_ids = None
+
+    for term in dict.fromkeys(vsm_query):
+        if term not in dictionary: continue
+
+        if file_operations.postings_format >= 4 and len(accumulator) * config.SKIP_BLOCK_SIZE < dictionary[term][2]:
+            # Few candidates against a long list: seek to each of them through the
+            # skip blocks instead of decoding the whole list
+            if sorted_doc_ids is None: sorted_doc_ids = sorted(accumulator)
+            cursor = file_operations.PostingsCursor(term, dictionary)
+            for doc_id in sorted_doc_ids:
+                if cursor.advance(doc_id) == doc_id:
+                    doc_wt = compute_log_term_freq(cursor.tf)
+                    accumulator[doc_id] += compute_term_score(float(doc_wt), float(doc_lengths[doc_id]), float(query_wt[term]), float(query_length_sqr))
+            continue
+
+        term_tfs = file_operations.retrieve_term_frequencies(term, dictionary)
+        for doc_id, tf in term_tfs.items():
+            if doc_id in accumulator:
+                doc_wt = compute_log_term_freq(tf)
+                accumulator[doc_id] += compute_term_score(float(doc_wt), float(doc_lengths[doc_id]), float(query_wt[term]), float(query_length_sqr))
+
+    # Squared lnc-ltc score - see general notes in README.txt
+    return {doc_id: score ** 2 * float(doc_lengths[doc_id]) * float(query_length_sqr) for doc_id, score in accumulator.items()}
+
+
+def accumulate_shard(doc_ids, dictionary, doc_lengths, query_wt, query_length_sqr, vsm_query):
+    # accumulate_scores over one shard of the candidates, for parallel scoring.
+    # doc_ids: sorted; only the part of each posting list between the first and last of them
+    # is read, through the skip blocks. Returns the scores in the order of doc_ids.
+    accumulator = {doc_id: 0 for doc_id in doc_ids}
+    first_doc_id = doc_ids[0]
+    last_doc_id = doc_ids[-1]
+
+    for term in dict.fromkeys(vsm_query):
+        if term not in dictionary: continue
+
+        cursor = file_operations.PostingsCursor(term, dictionary)
+        cursor.advance(first_doc_id)
+        while cursor.doc_id is not None and cursor.doc_id <= last_doc_id:
+            block_doc_ids, block_tfs = cursor.take_block()
+            for doc_id, tf in zip(block_doc_ids, block_tfs):
+                if doc_id > last_doc_id: break
+                if doc_id in accumulator:
+                    doc_wt = compute_log_term_freq(tf)
+                    accumulator[doc_id] += compute_term_score(float(doc_wt), float(doc_lengths[doc_id]), float(query_wt[term]), float(query_length_sqr))
+
+    # Squared lnc-ltc score - see general notes in README.txt
+    return [score ** 2 * float(doc_lengths[doc_id]) * float(query_length_sqr) for doc_id, score in accumulator.items()]
+
+
+def score_document(doc_id, term_frequencies, doc_lengths, query_wt, query_length_sqr):
+    # Exact squared lnc-ltc score of one document, summed in the same order and with the same
+    # operations as accumulate_scores so the two always agree to the last bit.
+    # term_frequencies: [(term, {doc_id: tf})] in query order
+    doc_length_sqr = float(doc_lengths[doc_id])
+    score = 0
+    for term, term_tfs in term_frequencies:
+        if doc_id in term_tfs:
+            doc_wt = compute_log_term_freq(term_tfs[doc_id])
+            score += compute_term_score(float(doc_wt), doc_length_sqr, float(query_wt[term]), float(query_length_sqr))
+    return score ** 2 * doc_length_sqr * float(query_length_sqr)
+
+
+def top_k_scores(doc_ids, dictionary, doc_lengths, query_wt, query_length_sqr, vsm_query, k):
+    # Returns the k best (doc_id, score) pairs of doc_ids, sorted by descending score and
+    # then doc_id, exactly as the first k of a full accumulate_scores and sort.
+    #
+    # MaxScore, term-at-a-time: the squared lnc-ltc score ranks documents the same as
+    # A(d) = sum of query_wt * doc_wt / |d| over the query terms, and the dictionary's
+    # max weight of a term bounds its contribution to A. Terms are visited from the highest
+    # bound down. Once the bounds of the remaining terms add up to less than the k-th best
+    # partial sum, no unseen document can enter the top k: from then on only existing
+    # accumulators are updated, and those that cannot reach the k-th best are dropped.
+    # The survivors are then scored exactly.
+    if k <= 0: return []
+
+    terms = [term for term in dict.fromkeys(vsm_query) if term in dictionary]
+    entries = {term: dictionary[term] for term in terms}
+
+    if len(doc_ids) <= k or any(len(entry) < 4 for entry in entries.values()):
+        # Nothing to prune, or an index without max weights
+        document_score_map = accumulate_scores(doc_ids, dictionary, doc_lengths, query_wt, query_length_sqr, vsm_query)
+        return sorted(document_score_map.items(), key=lambda x: (-x[1], x[0]))[:k]
+
+    bounds = {term: query_wt[term] * entries[term][3] for term in terms}
+    order = sorted(terms, key=lambda term: -bounds[term])
+
+    term_frequencies = {}
+    accumulator = {}
+    # K: doc_id
+    # V: partial A(d)
+    accumulating = True # Whether documents not seen yet can still enter the top k
+
+    for i, term in enumerate(order):
+        term_tfs = file_operations.retrieve_term_frequencies(term, dictionary)
+        term_frequencies[term] = term_tfs
+        term_query_wt = query_wt[term]
+
+        if accumulating:
+            for doc_id, tf in term_tfs.items():
+                if doc_id in doc_ids:
+                    accumulator[doc_id] = accumulator.get(doc_id, 0) + term_query_wt * compute_doc_weight(tf, doc_lengths[doc_id])
+        elif len(accumulator) < len(term_tfs):
+            for doc_id in accumulator:
+                if doc_id in term_tfs:
+                    accumulator[doc_id] += term_query_wt * compute_doc_weight(term_tfs[doc_id], doc_lengths[doc_id])
+        else:
+            for doc_id, tf in term_tfs.items():
+                if doc_id in accumulator:
+                    accumulator[doc_id] += term_query_wt * compute_doc_weight(tf, doc_lengths[doc_id])
+
+        if len(accumulator) < k: continue
+
+        # Compared with a small relative margin, so rounding can never prune a tie
+        remaining = sum(bounds[term] for term in order[i + 1:]) * (1 + TOP_K_MARGIN)
+        threshold = heapq.nlargest(k, accumulator.values())[-1]
+        if accumulating and remaining < threshold: accumulating = False
+        if not accumulating:
+            accumulator = {doc_id: partial for doc_id, partial in accumulator.items()
+                           if partial * (1 + TOP_K_MARGIN) + remaining >= threshold}
+
+    in_order = [(term, term_frequencies[term]) for term in terms]
+    top_k = heapq.nsmallest(k, ((doc_id, score_document(doc_id, in_order, doc_lengths, query_wt, query_length_sqr))
+                                for doc_id in accumulator), key=lambda x: (-x[1], x[0]))
+
+    if len(top_k) < k or top_k[-1][1] == 0:
+        # Documents of doc_ids outside every posting list score 0 and were never seen;
+        # they only make the top k by doc_id, so rank everything instead
+        document_score_map = accumulate_scores(doc_ids, dictionary, doc_lengths, query_wt, query_length_sqr, vsm_query)
+        return sorted(document_score_map.items(), key=lambda x: (-x[1], x[0]))[:k]
+
+    return top_k